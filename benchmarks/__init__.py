@@ -0,0 +1,4 @@
+"""
+Benchmarks for the slow parts of invoice. Each module can be run with
+`python -m benchmarks.<name>` from the top of the source tree.
+"""
@@ -0,0 +1,226 @@
+"""
+Builds a synthetic invoice database for benchmarking: accounts,
+clients, templates with letterheads, tags, invoices with their lines
+and totals, and timesheets with an entry per working day. It can also
+write org mode clock files to import.
+
+    python -m benchmarks.database DB [--invoices N] [--timesheets N] ...
+
+The database is created with model.create_database() like `invoice
+init` does, so it's at the current version. Rows are inserted in
+batches with executemany() rather than through the ORM so that large
+databases are quick to build. The same arguments always build the same
+database.
+"""
+
+import argparse
+import datetime
+from decimal import Decimal
+import io
+import json
+import os
+import random
+
+from invoice import model
+from invoice import __version__
+
+from .orgmode import write_org_file
+
+# Rows inserted per executemany() call
+BATCH_SIZE = 5000
+
+TEMPLATE = """taxes:
+   service: 0.14
+   kk_cess: 0.005
+rows: |
+        | Serial no | Description | Hours | Total |
+footer: |
+        | | | Net total | {net_total} |
+        | | | Service tax | {service} |
+        | | | KK cess | {kk_cess} |
+        | | | b:Gross total | {gross_total} |
+"""
+
+WORDS = ("design review implementation testing support consulting migration "
+         "deployment analysis documentation training maintenance").split()
+
+def letterhead(name):
+    """
+    Returns a one page letterhead PDF with `name` on it.
+    """
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import A4
+    out = io.BytesIO()
+    c = canvas.Canvas(out, pagesize = A4, invariant = 1)
+    width, height = A4
+    c.setFillColorRGB(0.2, 0.3, 0.5)
+    c.rect(0, height - 90, width, 90, stroke = 0, fill = 1)
+    c.setFillColorRGB(1, 1, 1)
+    c.setFont("Helvetica-Bold", 24)
+    c.drawString(40, height - 55, name)
+    c.setFillColorRGB(0.3, 0.3, 0.3)
+    c.setFont("Helvetica", 8)
+    c.drawCentredString(width / 2, 16, "{} - 1 Example Street, Example City - accounts@example.com".format(name))
+    c.save()
+    return out.getvalue()
+
+def insert(sess, table, rows):
+    """
+    Inserts the dictionaries in the iterable `rows` into `table` in
+    batches.
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            sess.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        sess.execute(table.insert(), batch)
+
+def create(db_file, accounts = 2, clients = 10, templates = 3, tags = 5, invoices = 1000, lines = 5,
+           timesheets = 100, days = 20, start = datetime.date(2010, 1, 1), seed = 0):
+    """
+    Creates the database `db_file` with the given numbers of rows.
+    Each invoice has about `lines` lines and each timesheet an entry
+    for each of `days` working days. Invoices and timesheets are spread
+    evenly from `start` to today.
+    """
+    rnd = random.Random(seed)
+    model.create_database(db_file)
+    sess = model.get_session(db_file)
+    sess.add(model.Config(name = "version", value = __version__, system = True))
+
+    insert(sess, model.Account.__table__,
+           (dict(id = i + 1, name = "Account {}".format(i), signatory = "Signatory {}".format(i),
+                 address = "{} Example Street\\nExample City".format(i), phone = "5550100",
+                 email = "accounts{}@example.com".format(i), pan = "ABCDE1234F", serv_tax_num = "ST1234",
+                 bank_details = "Example Bank\\nAccount {:010d}\\nIFSC EXMP0000{}".format(i, i),
+                 prefix = "A{}".format(i))
+            for i in range(accounts)))
+    client_names = ["client-{}".format(i) for i in range(clients)]
+    insert(sess, model.Client.__table__,
+           (dict(name = name, bill_unit = "INR", address = "{}\\n2 Client Road\\nClient Town".format(name),
+                 account_id = i % accounts + 1, billing_dom = i % 28 + 1)
+            for i, name in enumerate(client_names)))
+
+    template_names = []
+    for i in range(templates):
+        template = model.InvoiceTemplate(name = "template-{}".format(i), description = "Template {}".format(i))
+        template.set_template(TEMPLATE)
+        template.set_letterhead(sess, letterhead("Account {}".format(i % accounts)))
+        sess.add(template)
+        template_names.append(template.name)
+    sess.flush()
+    taxes = {k: Decimal(v) for k, v in json.loads(sess.query(model.InvoiceTemplate).first().compiled)['taxes'].items()}
+
+    tag_names = ["cancelled"] + ["tag-{}".format(i) for i in range(tags - 1)]
+    insert(sess, model.InvoiceTag.__table__,
+           (dict(name = name, system = name == "cancelled") for name in tag_names[:tags]))
+
+    span = (datetime.date.today() - start).days
+    numbers = {}
+    invoice_rows, line_rows, total_rows, tag_rows = [], [], [], []
+    def flush_invoices():
+        for table, rows in ((model.Invoice.__table__, invoice_rows),
+                            (model.InvoiceLine.__table__, line_rows),
+                            (model.InvoiceTotal.__table__, total_rows),
+                            (model.association_table, tag_rows)):
+            insert(sess, table, rows)
+            del rows[:]
+
+    for i in range(invoices):
+        invoice_id = i + 1
+        client = rnd.randrange(clients)
+        account = client % accounts
+        numbers[account] = numbers.get(account, 0) + 1
+        content = []
+        amounts = []
+        for position in range(max(1, int(rnd.gauss(lines, lines / 3)))):
+            hours = rnd.randint(1, 160)
+            amount = Decimal(hours * rnd.choice((1500, 2000, 2500)))
+            description = "{} {}".format(rnd.choice(WORDS).capitalize(), rnd.choice(WORDS))
+            cells = [str(position + 1), description, str(hours)]
+            content.append("| {} | {} |".format(" | ".join(cells), amount))
+            line_rows.append(dict(invoice_id = invoice_id, position = position, cells = json.dumps(cells),
+                                  amount = amount))
+            amounts.append(amount)
+        for position, (name, amount) in enumerate(model.compute_totals(amounts, taxes).items()):
+            total_rows.append(dict(invoice_id = invoice_id, name = name, position = position, amount = amount))
+        invoice_rows.append(dict(id = invoice_id, disp_number = numbers[account],
+                                 date = start + datetime.timedelta(days = span * i // invoices),
+                                 template_id = template_names[client % templates],
+                                 particulars = "Services for {}".format(rnd.choice(WORDS)),
+                                 client_id = client_names[client], content = "\n".join(content)))
+        if tags and rnd.random() < 0.3:
+            tag_rows.append(dict(invoice_id = invoice_id, tag_name = rnd.choice(tag_names)))
+        if len(line_rows) >= BATCH_SIZE:
+            flush_invoices()
+    flush_invoices()
+
+    timesheet_rows, entry_rows = [], []
+    for i in range(timesheets):
+        timesheet_id = i + 1
+        client = rnd.randrange(clients)
+        date = start + datetime.timedelta(days = span * i // max(timesheets, 1))
+        timesheet_rows.append(dict(id = timesheet_id, template_id = template_names[client % templates],
+                                   client_id = client_names[client], employee = "employee-{}".format(i % 50),
+                                   description = "Timesheet {}".format(i), date = date))
+        day = date - datetime.timedelta(days = days * 7 // 5)
+        for _ in range(days):
+            while day.weekday() >= 5:
+                day += datetime.timedelta(days = 1)
+            entry_rows.append(dict(timesheet_id = timesheet_id, date = day,
+                                   hours = Decimal(rnd.randint(8, 40)) / 4))
+            day += datetime.timedelta(days = 1)
+        if len(entry_rows) >= BATCH_SIZE:
+            insert(sess, model.Timesheet.__table__, timesheet_rows)
+            insert(sess, model.TimesheetEntry.__table__, entry_rows)
+            timesheet_rows, entry_rows = [], []
+    insert(sess, model.Timesheet.__table__, timesheet_rows)
+    insert(sess, model.TimesheetEntry.__table__, entry_rows)
+    sess.commit()
+    sess.close()
+
+def create_org_files(dir, files, lines, seed = 0):
+    """
+    Writes `files` org mode files of about `lines` lines each into
+    `dir` and returns their names.
+    """
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    fnames = []
+    for i in range(files):
+        fname = os.path.join(dir, "employee-{}.org".format(i))
+        write_org_file(fname, lines, seed = seed + i)
+        fnames.append(fname)
+    return fnames
+
+def main():
+    parser = argparse.ArgumentParser(description = "Build a synthetic invoice database")
+    parser.add_argument("db", help = "Database file to create")
+    parser.add_argument("--accounts", type = int, default = 2, help = "Default is %(default)s")
+    parser.add_argument("--clients", type = int, default = 10, help = "Default is %(default)s")
+    parser.add_argument("--templates", type = int, default = 3, help = "Templates, each with its own letterhead. Default is %(default)s")
+    parser.add_argument("--tags", type = int, default = 5, help = "Default is %(default)s")
+    parser.add_argument("--invoices", type = int, default = 1000, help = "Default is %(default)s")
+    parser.add_argument("--lines", type = int, default = 5, help = "Average lines per invoice. Default is %(default)s")
+    parser.add_argument("--timesheets", type = int, default = 100, help = "Default is %(default)s")
+    parser.add_argument("--days", type = int, default = 20, help = "Days in each timesheet. Default is %(default)s")
+    parser.add_argument("--org-dir", help = "Also write org mode clock files into this directory")
+    parser.add_argument("--org-files", type = int, default = 4, help = "Default is %(default)s")
+    parser.add_argument("--org-lines", type = int, default = 100000, help = "Lines in each org file. Default is %(default)s")
+    parser.add_argument("--seed", type = int, default = 0, help = "Default is %(default)s")
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        parser.error("{} already exists".format(args.db))
+    create(args.db, args.accounts, args.clients, args.templates, args.tags, args.invoices, args.lines,
+           args.timesheets, args.days, seed = args.seed)
+    print("{}: {:.1f} MB".format(args.db, os.path.getsize(args.db) / 1e6))
+    if args.org_dir:
+        for fname in create_org_files(args.org_dir, args.org_files, args.org_lines, args.seed):
+            print("{}: {:.1f} MB".format(fname, os.path.getsize(fname) / 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Times invoice.orgmode on a synthetic org file of a million lines,
+against the line by line parser it replaced, and the parallel parsing
+of many files used by `timesheet import`.
+
+    python -m benchmarks.orgmode [--lines N] [--files N] [--jobs N]
+"""
+
+import argparse
+from collections import defaultdict
+import datetime
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+
+from invoice import orgmode
+
+def write_org_file(fname, lines, seed = 0):
+    """
+    Writes an org file of about `lines` lines: a heading per working
+    day with a few clocked tasks, each followed by some notes.
+    """
+    rnd = random.Random(seed)
+    day = datetime.date(2010, 1, 1)
+    written = 0
+    with open(fname, "w") as f:
+        f.write("#+TITLE: Work log\n* Log\n")
+        while written < lines:
+            f.write("** <{} {}>\n".format(day.isoformat(), day.strftime("%a")))
+            written += 1
+            start = 9 * 60
+            for task in range(rnd.randint(2, 5)):
+                length = rnd.randint(10, 120)
+                d = day.strftime("%Y-%m-%d %a")
+                f.write("*** Task {}\n".format(task))
+                f.write("    :LOGBOOK:\n")
+                f.write("    CLOCK: [{} {:02d}:{:02d}]--[{} {:02d}:{:02d}] =>  {}:{:02d}\n".format(
+                    d, start // 60, start % 60, d, (start + length) // 60, (start + length) % 60,
+                    length // 60, length % 60))
+                f.write("    :END:\n")
+                notes = rnd.randint(0, 6)
+                for note in range(notes):
+                    f.write("    - Note {} about the work done on this task\n".format(note))
+                written += 4 + notes
+                start += length + 15
+            day += datetime.timedelta(days = 1)
+
+def line_by_line(fname):
+    """
+    The parser `timesheet import` used before invoice.orgmode: two
+    regular expressions searched against every line.
+    """
+    ret = defaultdict(int)
+    day_re = re.compile(r'\*\* [\[<](\d+)-(\d+)-(\d+) [a-zA-Z]+')
+    period_re = re.compile(r'.*CLOCK: \[(\d+)-(\d+)-(\d+) [a-zA-Z]+ (\d+):(\d+)\]--\[(\d+)-(\d+)-(\d+) [a-zA-Z]+ (\d+):(\d+)\] =>  \d+:\d+')
+    with open(fname) as f:
+        for i in f:
+            day = day_re.search(i)
+            period_search = period_re.search(i)
+            if day:
+                y, m, dom = day.groups()
+                cday = datetime.date(day=int(dom), month=int(m), year=int(y))
+            if period_search:
+                y0, m0, d0, hh0, mm0, y1, m1, d1, hh1, mm1 = period_search.groups()
+                t_start = datetime.datetime(year = int(y0), month = int(m0), day = int(d0),
+                                            hour = int(hh0), minute = int(mm0))
+                t_end = datetime.datetime(year = int(y1), month = int(m1), day = int(d1),
+                                          hour = int(hh1), minute = int(mm1))
+                ret[cday] += (t_end - t_start).total_seconds() / (60 * 60)
+    return ret
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    ret = fn(*args)
+    return time.perf_counter() - start, ret
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the org mode clock parser")
+    parser.add_argument("--lines", type = int, default = 1000000, help = "Lines in the big file. Default is %(default)s")
+    parser.add_argument("--files", type = int, default = 24, help = "Files for the parallel import. Default is %(default)s")
+    parser.add_argument("--jobs", type = int, default = os.cpu_count(), help = "Processes for the parallel import. Default is %(default)s")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix = "invoice-bench-")
+    try:
+        big = os.path.join(tmpdir, "big.org")
+        write_org_file(big, args.lines)
+        print("{}: {} lines, {:.1f} MB".format(big, args.lines, os.path.getsize(big) / 1e6))
+
+        old_time, old = timed(line_by_line, big)
+        new_time, new = timed(orgmode.clocked_hours, big)
+        assert {k: round(v, 6) for k, v in old.items()} == {k: round(float(v), 6) for k, v in new.items()}
+        print("line by line          : {:.2f}s".format(old_time))
+        print("orgmode.clocked_hours : {:.2f}s ({:.1f}x)".format(new_time, old_time / new_time))
+
+        fnames = []
+        for i in range(args.files):
+            fname = os.path.join(tmpdir, "employee-{}.org".format(i))
+            write_org_file(fname, args.lines // args.files, seed = i)
+            fnames.append(fname)
+        serial_time, _ = timed(orgmode.clocked_hours_batch, fnames, 1)
+        parallel_time, _ = timed(orgmode.clocked_hours_batch, fnames, args.jobs)
+        print("{} files, serial      : {:.2f}s".format(args.files, serial_time))
+        print("{} files, {} jobs     : {:.2f}s".format(args.files, args.jobs, parallel_time))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Times the commands that slow down as the database grows, on synthetic
+databases of 1k, 10k and 100k invoices built by benchmarks.database,
+and writes the results as JSON so that runs can be compared.
+
+    python -m benchmarks.scale [--scales N,N,...] [--output FILE] [--compare FILE]
+
+Each command is run as `python -m invoice.invoice` in a process of its
+own, the way it's used, with the render cache turned off. Its wall
+time, the CPU time and the peak resident memory of it and the worker
+processes it waited for are recorded. The databases are built in a
+process of their own too, since a child starts with the peak memory of
+the process it was started from.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from invoice import __version__
+
+FROM, TO = "01/Jan/2000", "31/Dec/2099"
+
+def commands(org_files, jobs):
+    """
+    Returns the commands to time as (name, arguments) pairs, in the
+    order they are run. `timesheet import` adds to the database, so
+    it's run after the commands that read it and before the dump.
+    """
+    jobs = ["-j", str(jobs)]
+    return [("invoice ls", ["invoice", "ls"]),
+            ("summary -v", ["summary", "-v"]),
+            ("invoice generate txt", ["invoice", "generate", "-f", FROM, "-t", TO, "--format", "txt"] + jobs),
+            ("invoice generate pdf", ["invoice", "generate", "-f", FROM, "-t", TO, "--format", "pdf"] + jobs),
+            ("timesheet generate pdf", ["timesheet", "generate", "-f", FROM, "-t", TO, "--format", "pdf"] + jobs),
+            ("timesheet parse", ["timesheet", "parse", org_files[0]]),
+            ("timesheet import", ["timesheet", "import", "-e", "bench", "-c", "client-0", "-t", "template-0",
+                                  "-s", "Benchmark import"] + jobs + org_files),
+            ("summary --dump", ["summary", "--dump"])]
+
+def run(argv):
+    """
+    Runs `argv` and returns its timings.
+    """
+    env = dict(os.environ, INVOICE_RENDER_CACHE = "")
+    with tempfile.TemporaryFile() as err:
+        start = time.perf_counter()
+        proc = subprocess.Popen(argv, stdout = subprocess.DEVNULL, stderr = err, env = env)
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        ret = dict(wall = round(wall, 3),
+                   user = round(usage.ru_utime, 3),
+                   sys = round(usage.ru_stime, 3),
+                   max_rss_kb = usage.ru_maxrss,
+                   returncode = proc.returncode)
+        if proc.returncode:
+            err.seek(0)
+            ret['error'] = err.read()[-2000:].decode(errors = "replace")
+    return ret
+
+def bench_scale(scale, tmpdir, jobs, only = None, seed = 0):
+    """
+    Builds the database for `scale` invoices in `tmpdir` and times each
+    command on it. Returns the results for the scale.
+    """
+    db = os.path.join(tmpdir, "invoices-{}.db".format(scale))
+    org_dir = os.path.join(tmpdir, "org-{}".format(scale))
+    build = run([sys.executable, "-m", "benchmarks.database", db,
+                 "--accounts", str(max(2, scale // 10000)), "--clients", str(max(10, scale // 100)),
+                 "--invoices", str(scale), "--timesheets", str(scale // 10),
+                 "--org-dir", org_dir, "--org-files", "4", "--org-lines", str(scale * 10),
+                 "--seed", str(seed)])
+    if build['returncode']:
+        raise RuntimeError("Building {} failed:\n{}".format(db, build['error']))
+    org_files = sorted(os.path.join(org_dir, x) for x in os.listdir(org_dir))
+    ret = dict(scale = scale,
+               database = dict(invoices = scale, timesheets = scale // 10,
+                               size = os.path.getsize(db), build = build['wall']),
+               org_files = dict(files = len(org_files), lines = scale * 10,
+                                size = sum(os.path.getsize(x) for x in org_files)),
+               commands = {})
+    print("{} invoices: database {:.1f} MB in {:.1f}s".format(scale, ret['database']['size'] / 1e6, build['wall']))
+    for name, args in commands(org_files, jobs):
+        if only and name not in only:
+            continue
+        output = os.path.join(tmpdir, "output-{}".format(scale))
+        result = run([sys.executable, "-m", "invoice.invoice", "-f", db, "-o", output] + args)
+        shutil.rmtree(output, ignore_errors = True)
+        ret['commands'][name] = result
+        print("  {:24} {:8.2f}s wall {:8.2f}s cpu {:8.1f} MB{}".format(
+            name, result['wall'], result['user'] + result['sys'], result['max_rss_kb'] / 1024,
+            "  (failed, exit status {})".format(result['returncode']) if result['returncode'] else ""))
+    return ret
+
+def compare(old, new):
+    """
+    Prints the wall time of each command in the results `new` against
+    the same command at the same scale in `old`.
+    """
+    before = {(x['scale'], name): result['wall']
+              for x in old['scales'] for name, result in x['commands'].items()}
+    print("Compared with {} ({}):".format(old['date'], old['version']))
+    for x in new['scales']:
+        for name, result in x['commands'].items():
+            if (x['scale'], name) in before and result['wall']:
+                print("  {:>7} {:24} {:8.2f}s -> {:8.2f}s ({:.2f}x)".format(
+                    x['scale'], name, before[x['scale'], name], result['wall'],
+                    before[x['scale'], name] / result['wall']))
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark invoice commands on large databases")
+    parser.add_argument("--scales", default = "1000,10000,100000",
+                        help = "Comma separated numbers of invoices. Default is %(default)s")
+    parser.add_argument("--jobs", type = int, default = 1,
+                        help = "Processes for generate and import. Default is %(default)s")
+    parser.add_argument("--commands", help = "Comma separated names of the commands to run. Default is all")
+    parser.add_argument("--output", default = "benchmark.json", help = "File to write the results to. Default is %(default)s")
+    parser.add_argument("--compare", help = "Results of an earlier run to compare with")
+    parser.add_argument("--keep", help = "Build the databases in this directory and leave them there")
+    parser.add_argument("--seed", type = int, default = 0, help = "Default is %(default)s")
+    args = parser.parse_args()
+
+    only = set(x.strip() for x in args.commands.split(",")) if args.commands else None
+    results = dict(version = __version__,
+                   python = platform.python_version(),
+                   platform = platform.platform(),
+                   cpus = os.cpu_count(),
+                   jobs = args.jobs,
+                   date = datetime.datetime.now().isoformat(timespec = "seconds"),
+                   scales = [])
+    tmpdir = args.keep or tempfile.mkdtemp(prefix = "invoice-bench-")
+    try:
+        for scale in (int(x) for x in args.scales.split(",")):
+            subdir = os.path.join(tmpdir, str(scale))
+            if os.path.exists(subdir):
+                shutil.rmtree(subdir)
+            os.makedirs(subdir)
+            results['scales'].append(bench_scale(scale, subdir, args.jobs, only, args.seed))
+    finally:
+        if not args.keep:
+            shutil.rmtree(tmpdir)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent = 2)
+    print("Results written to {}".format(args.output))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -1 +1 @@
-__version__ = "0.3.1-alpha"
+__version__ = "0.11.0-alpha"
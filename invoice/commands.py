@@ -1,28 +1,34 @@
 import datetime
 from collections import ChainMap, defaultdict
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+import csv
 import json
 import logging
 import os
-import re
+import sys
 
-from alembic import command
-import semver
-import yaml
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import or_
+from sqlalchemy.orm import joinedload, subqueryload
 
 
 
 from . import model
 from . import helpers
+from . import queries
+from . import orgmode
+from . import dump
 from . import formatters
+from .formatters.RenderCache import RenderCache
 from . import __version__
 
+DEFAULT_RENDER_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "invoice")
+
 class Command:
     def __init__(self, args, db_init = True):
-        defaults = dict(output="generated", chronological=False, format="txt", overwrite=False)
+        defaults = dict(output="generated", chronological=False, format="txt", overwrite=False, jobs=1, numbering="account",
+                        render_cache=DEFAULT_RENDER_CACHE, render_cache_size=256, reproducible=True)
         envars_config = {k.replace("INVOICE_", "").lower():v 
                          for k,v in os.environ.items() 
                          if k.startswith("INVOICE_")}
@@ -34,9 +40,9 @@ class Command:
 
         # Check database version
         if db_init:
-            sess = model.get_session(self.args['db'])
+            sess = model.get_session(self.args['db'], readonly = self.readonly())
             try:
-                db_version = sess.query(model.Config).filter(model.Config.name == "version").one().value
+                db_version = model.get_db_version(sess)
                 if db_version != __version__:
                     self.l.critical("Database version is %s. Software version is %s. Can't proceed.", db_version, __version__)
                     raise TypeError("Database version mismatch")
@@ -46,6 +52,23 @@ class Command:
                 raise
         
 
+    def readonly(self):
+        """
+        True if the command only reads from the database.
+        """
+        return self.args.get('op') in ("ls", "show", "report")
+
+    def get_formatter(self, fmt_name, dir = None):
+        """
+        Returns a formatter that uses the render cache unless it has
+        been turned off by setting INVOICE_RENDER_CACHE to "".
+        """
+        cache = None
+        if self.args['render_cache']:
+            max_size = int(self.args['render_cache_size']) * 1024 * 1024
+            cache = RenderCache(self.args['render_cache'], max_size)
+        return self.formatters[fmt_name](dir or self.args['output'], cache, self.args['reproducible'])
+
     def __call__(self):
         sc_name = self.args['op']
         self.l.debug(" Sub command %s", self.args['op'])
@@ -77,10 +100,13 @@ class DBCommand(Command):
         super().__init__(args, db_init = False)
         self.sc_handlers = {"info"   : self.info,
                             "update" : self.update,
-                            'migrate': self.migrate}
+                            'migrate': self.migrate,
+                            'explain': self.explain,
+                            'load'   : self.load}
 
 
     def info(self):
+        import semver
         sess = model.get_session(self.args['db'])
         db_version = sess.query(model.Config).filter(model.Config.name == "version").one().value
         print("Database version %s".format(db_version))
@@ -91,6 +117,8 @@ class DBCommand(Command):
             self.l.info("Database newer than software. Some operations will not be possible.")
     
     def update(self):
+        import semver
+        from alembic import command
         sess = model.get_session(self.args['db'])
         db_version = sess.query(model.Config).filter(model.Config.name == "version").one().value
         sw_version = __version__
@@ -99,7 +127,11 @@ class DBCommand(Command):
         self.l.debug("Software version %s", sw_version)
         self.l.debug("Database version %s", db_version)
         if semver.compare(db_version, sw_version) == -1:
-            command.upgrade(alembic_cfg, "head")
+            try:
+                command.upgrade(alembic_cfg, "head")
+            except ValueError as e:
+                self.l.critical("Can't update the database: %s", e)
+                raise
             version = sess.query(model.Config).filter(model.Config.name == "version").one()
             version.value = __version__
             sess.add(version)
@@ -111,6 +143,8 @@ class DBCommand(Command):
             self.l.info("No updates necessary.")
 
     def migrate(self):
+        import semver
+        from alembic import command
         sess = model.get_session(self.args['db'])
         db_version = sess.query(model.Config).filter(model.Config.name == "version").one().value
         sw_version = __version__
@@ -124,6 +158,27 @@ class DBCommand(Command):
         else:
             self.l.info("Migrations not nececssary. Database is not older than software")
 
+    def explain(self):
+        sess = model.get_session(self.args['db'])
+        for name, query in queries.builtin_queries(sess).items():
+            print("{}:".format(name))
+            for step in queries.query_plan(sess, query):
+                print("  {}".format(step))
+
+    def load(self):
+        sess = model.get_session(self.args['db'])
+        connection = sess.connection().connection
+        fname = self.args['dump']
+        with (sys.stdin if fname == "-" else open(fname)) as f:
+            try:
+                counts = dump.load(connection, f)
+            except ValueError as e:
+                self.l.critical("Can't load %s: %s", fname, e)
+                raise
+        sess.commit()
+        for table, count in sorted(counts.items()):
+            self.l.info("  %-20s %d rows", table, count)
+
 class InitCommand(Command):
     def __init__(self, args):
         super().__init__(args, db_init = False)
@@ -145,24 +200,16 @@ class InitCommand(Command):
 class SummaryCommand(Command):
     def __init__(self, args):
         super().__init__(args)
+
+    def readonly(self):
+        return True
     
     def serialise_db(self, sess):
-        ret = {}
-        config = sess.query(model.Config).all()
-        ret['config'] = [{"name" : i.name, "value" : i.value, "system" : i.system} for i in config]
-
-        accounts = sess.query(model.Account).all()
-        ret['accounts'] = [dict(id = i.id,
-                                name = i.name,
-                                address = i.address,
-                                phone = i.phone,
-                                email = i.email,
-                                pan = i.pan,
-                                serv_tax_num = i.serv_tax_num,
-                                bank_details = i.bank_details,
-                                prefix = i.prefix) for i in accounts]
-
-        print (json.dumps(ret))
+        connection = sess.connection().connection
+        # Read every table from the same snapshot
+        connection.execute("BEGIN")
+        dump.dump(connection, sys.stdout)
+        sess.rollback()
 
     def human_summary(self, sess):
         chronological = self.args['chronological']
@@ -173,29 +220,31 @@ class SummaryCommand(Command):
             print("{} {:10}:{:10}".format(system, i.name, i.value))
         print("-"*70)
         
-        for account in sess.query(model.Account).all():
+        invoices = defaultdict(list)
+        for invoice in queries.summary_invoices(sess, chronological):
+            invoices[invoice.client_id].append(invoice)
+        timesheets = defaultdict(list)
+        for timesheet in queries.summary_timesheets(sess, chronological):
+            timesheets[timesheet.client_id].append(timesheet)
+
+        for account in sess.query(model.Account).options(subqueryload(model.Account.clients)):
             print("Account: {}".format(account.name))
             if verbose:
                 print(account.summary(2))
             for client in account.clients:
-                invoices = sess.query(model.Invoice).filter(model.Invoice.client == client)
-                timesheets = sess.query(model.Timesheet).filter(model.Timesheet.client == client)
-                if chronological:
-                    invoices = invoices.order_by(model.Invoice.date)
-                    timesheets = timesheets.order_by(model.Timesheet.date)
                 print("    Client: {}".format(client.name))
                 if verbose:
                     print("      Address  : {}".format(helpers.wrap(client.address, 17)))
                     print("      Billed in: {}\n".format(client.bill_unit))
                     print("      Billed on {} of every month\n".format(client.billing_dom))
                 print("      Invoices:")
-                for invoice in invoices:
+                for invoice in invoices[client.name]:
                     if verbose:
                         print(invoice.summary(10)+"\n")
                     else:
                         print("       {} | {} | {}".format(invoice.id, invoice.date.strftime("%d %b %Y") , invoice.particulars))
                 print("      Timesheets:")
-                for timesheet in timesheets:
+                for timesheet in timesheets[client.name]:
                     if verbose:
                         print(timesheet.summary(10)+"\n")
                     else:
@@ -210,7 +259,7 @@ class SummaryCommand(Command):
 
 
     def __call__(self):
-        sess = model.get_session(self.args['db'])
+        sess = model.get_session(self.args['db'], readonly = True)
         if self.args['dump']:
             self.serialise_db(sess)
         else:
@@ -227,7 +276,7 @@ class TemplateCommand(Command):
                             "ls"   : self.list_}
 
     def list_(self):
-        sess = model.get_session(self.args['db'])
+        sess = model.get_session(self.args['db'], readonly = True)
         print("Templates :")
         for template in sess.query(model.InvoiceTemplate).all():
             print("{:20} | {} ".format(template.name, template.description))
@@ -236,6 +285,7 @@ class TemplateCommand(Command):
 
 
     def add(self):
+        import yaml
         template = """# -*- yaml -*-
 # Local Variables: 
 # eval: (orgtbl-mode) 
@@ -266,9 +316,10 @@ footer: |
         for i in range(2):
             fname, template = helpers.get_from_file(template)
             try:
-                yaml.load(template)
+                model.compile_template(template)
                 break
-            except yaml.YAMLError:
+            except (yaml.YAMLError, ValueError) as e:
+                self.l.error("%s", e)
                 if i != 1:
                     self.l.warn("Error in input. Please check again")
                     input()
@@ -281,15 +332,16 @@ footer: |
             with open(self.args['letterhead'], "rb") as f:
                 letterhead = f.read()
 
-        temp = model.InvoiceTemplate(name = self.args['name'], 
-                                     description = self.args['desc'], 
-                                     template = template,
-                                     letterhead = letterhead)
         sess = model.get_session(self.args['db'])
+        temp = model.InvoiceTemplate(name = self.args['name'], 
+                                     description = self.args['desc'])
+        temp.set_template(template)
+        temp.set_letterhead(sess, letterhead)
         sess.add(temp)
         sess.commit()
 
     def edit(self):
+        import yaml
         sess = model.get_session(self.args['db'])
         try:
             template = sess.query(model.InvoiceTemplate).filter(model.InvoiceTemplate.name==self.args['name']).one()
@@ -299,7 +351,7 @@ footer: |
         if 'letterhead' in self.args:
             with open(self.args['letterhead'], "rb") as f:
                 letterhead = f.read()
-                template.letterhead = letterhead
+                template.set_letterhead(sess, letterhead)
                 self.l.debug("Updated letterhead")
         if 'desc' in self.args:
             template.description = self.args['desc']
@@ -308,11 +360,13 @@ footer: |
             for i in range(2):
                 fname, new_template = helpers.get_from_file(template.template)
                 try:
-                    yaml.load(new_template)
-                    template.template = new_template
+                    template.set_template(new_template)
                     self.l.debug("Template of %s updated", self.args['name'])
+                    for invoice in queries.template_invoices(sess, template.name):
+                        invoice.update_totals()
                     break
-                except yaml.YAMLError:
+                except (yaml.YAMLError, ValueError) as e:
+                    self.l.error("%s", e)
                     if i != 1:
                         self.l.warn("Error in input. Please check again")
                         input()
@@ -321,6 +375,7 @@ footer: |
                 raise ValueError("Bad format in invoice template. Can't proceed.")
 
         sess.add(template)
+        model.Letterhead.prune(sess)
         sess.commit()
         self.l.debug("Saved")
         
@@ -332,6 +387,7 @@ footer: |
             self.l.critical("No such template '%s'", self.args['name'])
             raise
         sess.delete(template)
+        model.Letterhead.prune(sess)
         sess.commit()
 
     
@@ -348,7 +404,7 @@ class AccountCommand(Command):
                             'show' : self.show}
 
     def show(self):
-        sess = model.get_session(self.args['db'])
+        sess = model.get_session(self.args['db'], readonly = True)
         name = self.args['account']
         try:
             account = sess.query(model.Account).filter(model.Account.name == name).one()
@@ -409,7 +465,7 @@ class AccountCommand(Command):
         sess.commit()
 
     def list(self):
-        sess = model.get_session(self.args['db'])
+        sess = model.get_session(self.args['db'], readonly = True)
         print("Accounts")
         for i in sess.query(model.Account).all():
             print(" {:5} | {}".format(i.id, i.name))
@@ -424,7 +480,7 @@ class ClientCommand(Command):
         }
 
     def show(self):
-        sess = model.get_session(self.args['db'])
+        sess = model.get_session(self.args['db'], readonly = True)
         client = self.args['name']
         try:
             client = sess.query(model.Client).filter(model.Client.name == client).one()
@@ -438,10 +494,14 @@ class ClientCommand(Command):
         print("Address     :\n{}".format(client.address))
 
         
+        _, rows = queries.report(sess, "client", client = client.name)
+        totals = rows[0] if rows else dict(invoices = 0, net_total = 0, gross_total = 0, hours = 0)
         print("-"*50)
-        print("Total income      : {}".format("TBD"))
-        print("Total debits      : {}".format("TBD"))
-        print("Total time billed : {}".format("TBD"))
+        print("Invoices          : {}".format(totals['invoices']))
+        print("Total income      : {} {}".format(totals['gross_total'], client.bill_unit))
+        # Taxes collected on the client's invoices
+        print("Total debits      : {} {}".format(totals['gross_total'] - totals['net_total'], client.bill_unit))
+        print("Total time billed : {} hours".format(totals['hours']))
 
         
     def edit(self):
@@ -501,9 +561,9 @@ class ClientCommand(Command):
 
     
     def list(self):
-        sess = model.get_session(self.args['db'])
+        sess = model.get_session(self.args['db'], readonly = True)
         print("Clients")
-        for i in sess.query(model.Client).all():
+        for i in sess.query(model.Client).options(joinedload(model.Client.account)):
             print(" {:>5} | {} ".format(i.name, i.account.name))
 
 
@@ -515,42 +575,30 @@ class InvoiceCommand(Command):
                             'edit' : self.edit,
                             'show' : self.show,
                             "rm" : self.rm, 
-                            "ls" : self.list}
+                            "ls" : self.list,
+                            "recompute" : self.recompute,
+                            "report" : self.report}
     
     def show(self):
-        sess = model.get_session(self.args['db'])
+        sess = model.get_session(self.args['db'], readonly = True)
         inv_id = int(self.args['id'])
         invoice = sess.query(model.Invoice).filter(model.Invoice.id == inv_id).one()
-        text_formatter = self.formatters['txt']()
+        text_formatter = self.get_formatter('txt')
         generated_invoice = text_formatter.generate_invoice(invoice, True, False)
         print("\n{}\n".format(generated_invoice))
 
         
     def list(self):
-        sess = model.get_session(self.args['db'])
+        sess = model.get_session(self.args['db'], readonly = True)
         tags = self.args['tag']
         from_ = None if self.args['from'] == 'a' else datetime.datetime.strptime(self.args['from'], "%d/%b/%Y")
         to = datetime.datetime.strptime(self.args['to'], "%d/%b/%Y")
         all_ = self.args['all']
         client = self.args.get('client')
-        if tags:
-            invoices = sess.query(model.Invoice).filter(model.Invoice.tags.any(model.InvoiceTag.name.in_(tags)))
-        else:
-            invoices = sess.query(model.Invoice)
-
-        if from_:
-            invoices = invoices.filter(from_ <= model.Invoice.date)
-
-        invoices = invoices.filter(model.Invoice.date <= to)
-        
-        if not all_:
-            invoices = invoices.filter(model.Invoice.tags.any(model.InvoiceTag.name != 'cancelled'))
-
         if client:
-            client = sess.query(model.Client).filter(model.Client.name == client).one()
-            invoices = invoices.filter(model.Invoice.client == client)
-            
-        invoices = invoices.all()
+            client = sess.query(model.Client).filter(model.Client.name == client).one().name
+
+        invoices = queries.invoice_list(sess, from_, to, client, tags, all_).all()
         if invoices:
             for invoice in invoices:
                 tags = ", ".join (x.name for x in invoice.tags)
@@ -588,44 +636,52 @@ class InvoiceCommand(Command):
 |{}|
 
 """.format(", ".join(fields), "|".join(["          "]*len(fields)))
-        last_invoice_disp_number = sess.query(model.Invoice).order_by(model.Invoice.id)[-1].disp_number
-
         _, data = helpers.get_from_file(boilerplate)
-        invoice = model.Invoice(date = date,
-                                disp_number = last_invoice_disp_number+1,
-                                particulars = subject,
-                                content = data,
-                                template = template,
-                                client = client)
+
+        invoice = model.Invoice(date = date, particulars = subject)
+        self.set_content(invoice, data)
+
+        year = model.financial_year(date) if self.args['numbering'] == "yearly" else 0
+        invoice.disp_number = model.allocate_invoice_numbers(sess, client.account, year)
+        invoice.template = template
+        invoice.client = client
+        invoice.update_totals()
         sess.add(invoice)
         sess.commit()
         self.l.info("Added invoice with number %d(%s)", invoice.id, invoice.number)
         
+    def set_content(self, invoice, content):
+        try:
+            invoice.set_content(content)
+        except InvalidOperation:
+            self.l.critical("The last column of every row should be an amount")
+            raise
+
     def generate(self):
         sess = model.get_session(self.args['db'])
         date_start = datetime.datetime.strptime(self.args['from'], "%d/%b/%Y")
         date_to = datetime.datetime.strptime(self.args['to'], "%d/%b/%Y")
         fmt_name = self.args['format']
-        formatter = self.formatters[fmt_name](self.args['output'])
+        formatter = self.get_formatter(fmt_name)
         client = self.args['client']
         overwrite = self.args['overwrite']
+        jobs = int(self.args['jobs'])
+        bundle = self.args['bundle']
         id = self.args['id']
 
-        query = sess.query(model.Invoice).join(model.Client)
         if id != -1:
             self.l.info("Generating invoice with id %s", id)
-            invoices = query.filter(model.Invoice.id == id).all()
+            invoices = queries.invoice_details(sess.query(model.Invoice)).filter(model.Invoice.id == id).all()
         else:
             self.l.info("Invoices between %s and %s", self.args['from'], self.args['to'])
-            invoices = query.filter(date_start <= model.Invoice.date,
-                                    model.Invoice.date <= date_to)
             if client:
                 self.l.info("Limiting to client %s", client)
-                invoices = invoices.filter(model.Client.name == client)
-            invoices = invoices.all()
-        if invoices:
-            for invoice in invoices:
-                fname = formatter.generate_invoice(invoice, False, overwrite)
+            invoices = queries.invoice_range(sess, date_start, date_to, client).all()
+        if invoices and bundle:
+            formatter.generate_bundle("invoice", invoices, bundle, jobs)
+            self.l.info("  Generated %d invoices in %s", len(invoices), bundle)
+        elif invoices:
+            for fname in formatter.generate_batch("invoice", invoices, overwrite, jobs):
                 self.l.info("  Generated invoice %s", fname)
         else:
             self.l.critical("No invoices found matching these criteria")
@@ -689,6 +745,7 @@ class InvoiceCommand(Command):
             try:
                 template  = sess.query(model.InvoiceTemplate).filter(model.InvoiceTemplate.name == template).one()
                 invoice.template = template
+                invoice.update_totals()
             except NoResultFound:
                 self.l.critical("No such template '%s'", template)
                 raise
@@ -699,11 +756,58 @@ class InvoiceCommand(Command):
 
         if edit_content:
             _, data = helpers.get_from_file(invoice.content)
-            invoice.content = data
+            self.set_content(invoice, data)
 
         sess.add(invoice)
         sess.commit()
 
+
+    def report(self):
+        sess = model.get_session(self.args['db'], readonly = True)
+        from_ = self.args['from'] and datetime.datetime.strptime(self.args['from'], "%d/%b/%Y")
+        to = self.args['to'] and datetime.datetime.strptime(self.args['to'], "%d/%b/%Y")
+        group = self.args['group_by']
+        names, rows = queries.report(sess, group, from_, to, self.args['client'], self.args['all'])
+        fmt = self.args['report_format']
+
+        if fmt == "json":
+            print(json.dumps(rows, indent = 2, default = str))
+            return
+        headers = [group, "invoices"] + names
+        if group != "tag":
+            headers.append("hours")
+        if fmt == "csv":
+            writer = csv.writer(sys.stdout)
+            writer.writerow(headers)
+            writer.writerows([row[x] for x in headers] for row in rows)
+            return
+
+        if not rows:
+            self.l.info("No invoices matching criteria")
+            return
+        widths = [max(len(str(x)) for x in [h] + [row[h] for row in rows]) for h in headers]
+        fmt_string = " | ".join("{{:>{}}}".format(x) for x in widths)
+        self.l.info(fmt_string.format(*headers))
+        self.l.info("-+-".join("-"*x for x in widths))
+        for row in rows:
+            self.l.info(fmt_string.format(*[str(row[h]) for h in headers]))
+
+    def recompute(self):
+        sess = model.get_session(self.args['db'])
+        template = self.args['template']
+        if template:
+            try:
+                sess.query(model.InvoiceTemplate).filter(model.InvoiceTemplate.name == template).one()
+            except NoResultFound:
+                self.l.critical("No such template '%s'", template)
+                raise
+        count = 0
+        for invoice in queries.template_invoices(sess, template):
+            invoice.update_totals()
+            count += 1
+        sess.commit()
+        self.l.info("Recomputed totals of %d invoices", count)
+
         
 class TagCommand(Command):
     def __init__(self, args):
@@ -716,7 +820,7 @@ class TagCommand(Command):
                             # }
 
     def list(self):
-        sess = model.get_session(self.args['db'])
+        sess = model.get_session(self.args['db'], readonly = True)
         self.l.info("Tags:")
         for t in sess.query(model.InvoiceTag).all():
             self.l.info(" %s %s", t.name, "*" if t.system else '')
@@ -753,34 +857,29 @@ class TimesheetCommand(Command):
                             'parse'    : self.parse}
 
     def show(self):
-        sess = model.get_session(self.args['db'])
+        sess = model.get_session(self.args['db'], readonly = True)
         ts_id = int(self.args['id'])
         timesheet = sess.query(model.Timesheet).filter(model.Timesheet.id == ts_id).one()
-        text_formatter = self.formatters['txt']()
+        text_formatter = self.get_formatter('txt')
         generated_timesheet = text_formatter.generate_timesheet(timesheet, True, False)
         print("\n{}\n".format(generated_timesheet))
 
     
     def parse(self):
-        with open(self.args['timesheet']) as f:
-            timesheet = json.loads(self.parse_timesheet(f))
-            self.l.info("\nParsed timesheet:")
-            data = sorted(timesheet.items(), key=lambda x: datetime.datetime.strptime(x[0], '%d/%m/%Y %a'))
-            total = Decimal(0.0)
-            for k,v in data:
-                value = Decimal(v)
-                total += value
-                self.l.info("%15s | %+6s ", k, value.quantize(Decimal('0.01')))
-
-            self.l.info("----------------+-------")
-            self.l.info("%15s | %+6s\n", "Total", total.quantize(Decimal('0.01')))
+        timesheet = orgmode.clocked_hours(self.args['timesheet'])
+        self.l.info("\nParsed timesheet:")
+        total = Decimal(0.0)
+        for k,v in sorted(timesheet.items()):
+            total += v
+            self.l.info("%15s | %+6s ", k.strftime(model.TIMESHEET_DAY_FORMAT), v.quantize(Decimal('0.01')))
+
+        self.l.info("----------------+-------")
+        self.l.info("%15s | %+6s\n", "Total", total.quantize(Decimal('0.01')))
         
 
     def ls(self):
-        sess = model.get_session(self.args['db'])
-        timesheets = sess.query(model.Timesheet)
-        if self.args['chronological']:
-            timesheets = timesheets.order_by(model.Timesheet.date)
+        sess = model.get_session(self.args['db'], readonly = True)
+        timesheets = queries.timesheet_list(sess, self.args['chronological'])
         
         self.l.info("Timesheets:")
         for timesheet in timesheets.all():
@@ -847,58 +946,37 @@ class TimesheetCommand(Command):
         sess.add(timesheet)
         sess.commit()
 
-    def parse_timesheet(self, data):
-        ret = defaultdict(int)
-        day_re = re.compile(r'\*\* [[<](\d+)-(\d+)-(\d+) [a-zA-Z]+')
-        period_re = re.compile(r'.*CLOCK: \[(\d+)-(\d+)-(\d+) [a-zA-Z]+ (\d+):(\d+)\]--\[(\d+)-(\d+)-(\d+) [a-zA-Z]+ (\d+):(\d+)\] =>  \d+:\d+')
-        for i in data:
-            day = day_re.search(i)
-            period_search = period_re.search(i)
-            if day:
-                y, m, dom = day.groups()
-                cday = datetime.date(day=int(dom), month=int(m), year=int(y)).strftime('%d/%m/%Y %a')
-                self.l.debug("Adding entries for %s", cday)
-            if period_search:
-                y0, m0, d0, hh0, mm0, y1, m1, d1, hh1, mm1 = period_search.groups()
-                t_start = datetime.datetime(year = int(y0), month = int(m0), day = int(d0), 
-                                            hour = int(hh0), minute = int(mm0))
-                t_end = datetime.datetime(year = int(y1), month = int(m1), day = int(d1), 
-                                          hour = int(hh1), minute = int(mm1))
-                duration = (t_end - t_start).total_seconds() / (60 * 60)
-                self.l.debug("  %s to %s = %s", t_start, t_end, duration)
-                ret[cday] += duration
-        return json.dumps(ret)
-
     def generate(self):
         sess = model.get_session(self.args['db'])
         id = model.get_session(self.args['id'])
         date_start = datetime.datetime.strptime(self.args['from'], "%d/%b/%Y")
         date_to = datetime.datetime.strptime(self.args['to'], "%d/%b/%Y")
         fmt_name = self.args['format']
-        formatter = self.formatters[fmt_name](self.args['output'])
+        formatter = self.get_formatter(fmt_name)
         employee = self.args['employee']
         client = self.args['client']
         overwrite = self.args['overwrite']
+        jobs = int(self.args['jobs'])
+        bundle = self.args['bundle']
         id = self.args['id']
 
         if id != -1:
             self.l.info("Generating timesheet with %s", id)
-            j = sess.query(model.Timesheet).filter(model.Timesheet.id == id)
+            j = queries.timesheet_details(sess.query(model.Timesheet)).filter(model.Timesheet.id == id)
         else:
             self.l.info("Timesheets between %s and %s", self.args['from'], self.args['to'])
-            j = sess.query(model.Timesheet).join(model.Client).filter(date_start <= model.Timesheet.date,
-                                                                      model.Timesheet.date <= date_to)
             if client:
                 self.l.info("Filtering by client %s", client)
-                j = j.filter(model.Client.name == client)
             if employee:
                 self.l.info("Filtering by employee %s", employee)
-                j = j.filter(model.Timesheet.employee == employee)
+            j = queries.timesheet_range(sess, date_start, date_to, client, employee)
 
         timesheets = j.all()
-        if timesheets:
-            for timesheet in timesheets:
-                fname = formatter.generate_timesheet(timesheet, False, overwrite)
+        if timesheets and bundle:
+            formatter.generate_bundle("timesheet", timesheets, bundle, jobs)
+            self.l.info("  Generated %d timesheets in %s", len(timesheets), bundle)
+        elif timesheets:
+            for fname in formatter.generate_batch("timesheet", timesheets, overwrite, jobs):
                 self.l.info("  Generated timesheet %s", fname)
 
         else:
@@ -960,19 +1038,48 @@ class TimesheetCommand(Command):
         try:
             client = sess.query(model.Client).filter(model.Client.name == self.args['client']).one()
         except NoResultFound:
-            self.l.critical("No such client '%s'", client)
+            self.l.critical("No such client '%s'", self.args['client'])
             raise
 
-        with open(self.args['timesheet']) as f:
-            timesheet = self.parse_timesheet(f)
+        fnames = orgmode.find_org_files(self.args['timesheet'])
+        if not fnames:
+            self.l.critical("No org files found")
+            raise ValueError("Nothing to import")
+        jobs = int(self.args['jobs'])
 
-        t = model.Timesheet(employee = employee,
-                            template = template,
-                            description = description,
-                            client = client,
-                            date = date,
-                            data = timesheet)
-        sess.add(t)
+        def new_timesheet(hours):
+            t = model.Timesheet(employee = employee,
+                                template = template,
+                                description = description,
+                                client = client,
+                                date = date)
+            t.set_entries(hours)
+            sess.add(t)
+            return t
+
+        if not self.args['incremental']:
+            for fname, hours in zip(fnames, orgmode.clocked_hours_batch(fnames, jobs)):
+                new_timesheet(hours)
+                self.l.info("Imported %s (%d days)", fname, len(hours))
+        else:
+            paths = [os.path.abspath(x) for x in fnames]
+            sources = {x.path: x for x in sess.query(model.TimesheetSource).filter(model.TimesheetSource.path.in_(paths))}
+            watermarks = [orgmode.Watermark(x.offset, x.checksum, x.day, x.size, x.inode) if x else None
+                          for x in (sources.get(path) for path in paths)]
+            for path, (hours, watermark, complete) in zip(paths, orgmode.clocked_hours_batch(paths, jobs, watermarks)):
+                source = sources.get(path)
+                if source is None:
+                    source = model.TimesheetSource(path = path)
+                    new_timesheet(hours).sources.append(source)
+                    self.l.info("Imported %s (%d days)", path, len(hours))
+                elif complete:
+                    source.timesheet.set_entries(hours)
+                    self.l.info("Imported %s again since it has changed (%d days)", path, len(hours))
+                else:
+                    source.timesheet.add_entries(hours)
+                    self.l.info("Added %d days from %s to timesheet %s", len(hours), path, source.timesheet_id)
+                source.offset, source.checksum, source.day, source.size, source.inode = watermark
+        # All the timesheets go in together or not at all
         sess.commit()
 
 
@@ -0,0 +1,105 @@
+"""
+Dumping the whole database for `summary --dump` and loading it back
+with `db load`.
+
+A dump is newline delimited JSON. The first line says which version of
+the software wrote it and each of the others is one row of a table:
+
+    {"format": "invoice", "version": "0.10.0-alpha"}
+    {"table": "accounts", "row": {"id": 1, "name": "...", ...}}
+
+Rows hold the values as they are stored in SQLite (dates as text,
+amounts as integer hundredths) except for BLOBs like letterheads which
+are base64 encoded. Tables are written parents first so a dump can be
+loaded in order. Loading replaces everything in the database with the
+contents of the dump. Both directions work a row at a time, so memory
+use doesn't grow with the size of the database.
+"""
+
+import base64
+import itertools
+import json
+
+from sqlalchemy import LargeBinary
+
+from . import model
+from . import __version__
+
+# Rows inserted per executemany() call by load()
+LOAD_BATCH_SIZE = 5000
+
+def blob_columns(table):
+    return {x.name for x in table.columns if isinstance(x.type, LargeBinary)}
+
+def dump(dbapi_connection, out):
+    """
+    Writes every table in `dbapi_connection` to the file `out`.
+    """
+    out.write(json.dumps({"format" : "invoice", "version" : __version__}) + "\n")
+    for table in model.Base.metadata.sorted_tables:
+        names = [x.name for x in table.columns]
+        blobs = blob_columns(table)
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SELECT {} FROM "{}"'.format(", ".join('"{}"'.format(x) for x in names), table.name))
+        for values in cursor:
+            row = dict(zip(names, values))
+            for name in blobs:
+                if row[name] is not None:
+                    row[name] = base64.b64encode(row[name]).decode("ascii")
+            out.write(json.dumps({"table" : table.name, "row" : row}) + "\n")
+        cursor.close()
+
+def load(dbapi_connection, lines):
+    """
+    Replaces the contents of every table in `dbapi_connection` with the
+    rows in `lines` (a dump) and returns the number of rows loaded from
+    each table. Raises ValueError if the dump or the database is of a
+    different version than the software, or the dump has a table the
+    software doesn't know.
+
+    The caller is responsible for committing.
+    """
+    lines = iter(lines)
+    header = json.loads(next(lines, "{}"))
+    if header.get("format") != "invoice":
+        raise ValueError("Not a dump of an invoice database")
+    if header.get("version") != __version__:
+        raise ValueError("Dump is of version {}. Software version is {}".format(header.get("version"), __version__))
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute('SELECT value FROM "{}" WHERE name = ?'.format(model.Config.__tablename__), ("version",))
+    version = cursor.fetchone()
+    if version is None:
+        raise ValueError("Database is not initialised")
+    if version[0] != __version__:
+        raise ValueError("Database is of version {}. Software version is {}".format(version[0], __version__))
+
+    tables = model.Base.metadata.tables
+    # Children first, so that no row is left referring to a deleted one
+    for table in reversed(model.Base.metadata.sorted_tables):
+        cursor.execute('DELETE FROM "{}"'.format(table.name))
+    counts = {}
+    records = (json.loads(x) for x in lines if x.strip())
+    for name, group in itertools.groupby(records, key = lambda x: x["table"]):
+        if name not in tables:
+            raise ValueError("Unknown table '{}'".format(name))
+        table = tables[name]
+        names = [x.name for x in table.columns]
+        blobs = blob_columns(table)
+        statement = 'INSERT INTO "{}" ({}) VALUES ({})'.format(name,
+                                                              ", ".join('"{}"'.format(x) for x in names),
+                                                              ", ".join("?" for x in names))
+        while True:
+            batch = []
+            for record in itertools.islice(group, LOAD_BATCH_SIZE):
+                row = record["row"]
+                for blob in blobs:
+                    if row.get(blob) is not None:
+                        row[blob] = base64.b64decode(row[blob])
+                batch.append([row.get(x) for x in names])
+            if not batch:
+                break
+            cursor.executemany(statement, batch)
+            counts[name] = counts.get(name, 0) + len(batch)
+    cursor.close()
+    return counts
@@ -0,0 +1,134 @@
+import io
+
+from PyPDF2 import PdfFileReader
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+from reportlab.pdfbase.pdfdoc import PDFObject
+
+def serialise(obj):
+    out = io.BytesIO()
+    obj.writeToStream(out, None)
+    return out.getvalue()
+
+def write(node, document, refs):
+    if isinstance(node, bytes):
+        return node
+    return node.write(document, refs)
+
+class Ref:
+    def __init__(self, key):
+        self.key = key
+
+    def write(self, document, refs):
+        return refs[self.key].format(document)
+
+class Array:
+    def __init__(self, items):
+        self.items = items
+
+    def write(self, document, refs):
+        return b"[" + b" ".join(write(x, document, refs) for x in self.items) + b"]"
+
+class Dict:
+    def __init__(self, items):
+        self.items = items
+
+    def write(self, document, refs, extra = b""):
+        return (b"<<" + b"".join(b" " + k + b" " + write(v, document, refs) for k, v in self.items)
+                + extra + b" >>")
+
+class Stream:
+    def __init__(self, dictionary, data):
+        self.dictionary = dictionary
+        self.data = data
+
+    def write(self, document, refs):
+        length = " /Length {}".format(len(self.data)).encode("ascii")
+        return (self.dictionary.write(document, refs, length)
+                + b"\nstream\n" + self.data + b"\nendstream")
+
+class Indirect(PDFObject):
+    """
+    An object of the letterhead registered with one ReportLab document.
+    `refs` maps the letterhead's objects to their references in that
+    document.
+    """
+    def __init__(self, node, refs):
+        self.node = node
+        self.refs = refs
+
+    def format(self, document):
+        return write(self.node, document, self.refs)
+
+
+class LetterheadForm:
+    """
+    The first page of a letterhead PDF as a form XObject that can be
+    drawn on a ReportLab canvas, so that a document is laid out on top
+    of its letterhead in one pass instead of being merged onto it
+    afterwards.
+
+    The page is read and converted once. Its objects are copied into
+    each document as they are, with streams left compressed, and only
+    the references between them are renumbered.
+    """
+    def __init__(self, letterhead, name):
+        page = PdfFileReader(io.BytesIO(letterhead)).getPage(0)
+        self.name = name
+        self.width = float(page.mediaBox.getWidth())
+        self.height = float(page.mediaBox.getHeight())
+        self.objects = {}
+
+        contents = page['/Contents']
+        if isinstance(contents, ArrayObject):
+            data = b"\n".join(x.getObject().getData() for x in contents)
+            filters = []
+        else:
+            data = contents._data
+            filters = [(serialise(k), self.convert(v)) for k, v in contents.items()
+                       if k in ('/Filter', '/DecodeParms')]
+        items = [(b"/Type", b"/XObject"),
+                 (b"/Subtype", b"/Form"),
+                 (b"/FormType", b"1"),
+                 (b"/BBox", self.convert(page.mediaBox))]
+        if '/Resources' in page:
+            items.append((b"/Resources", self.convert(dict.__getitem__(page, '/Resources'))))
+        self.form = Stream(Dict(items + filters), data)
+
+    def convert(self, obj):
+        """
+        Converts a PyPDF2 object into one that can be written into a
+        ReportLab document. Indirect objects are converted once and
+        referred to by their object number.
+        """
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key not in self.objects:
+                self.objects[key] = None
+                self.objects[key] = self.convert(obj.getObject())
+            return Ref(key)
+        if isinstance(obj, StreamObject):
+            return Stream(Dict([(serialise(k), self.convert(v)) for k, v in obj.items() if k != '/Length']),
+                          obj._data)
+        if isinstance(obj, DictionaryObject):
+            return Dict([(serialise(k), self.convert(v)) for k, v in obj.items()])
+        if isinstance(obj, ArrayObject):
+            return Array([self.convert(x) for x in obj])
+        return serialise(obj)
+
+    def draw(self, canvas, doc = None):
+        """
+        Draws the letterhead on the current page of `canvas` and makes
+        the page the size of the letterhead. Can be used as the onPage
+        callback of a ReportLab document template.
+        """
+        document = canvas._doc
+        xobject = document.getXObjectName(self.name)
+        if xobject not in document.idToObject:
+            refs = {}
+            for key, node in self.objects.items():
+                refs[key] = document.Reference(Indirect(node, refs))
+            document.Reference(Indirect(self.form, refs), xobject)
+        canvas.setPageSize((self.width, self.height))
+        canvas.saveState()
+        canvas.doForm(self.name)
+        canvas.restoreState()
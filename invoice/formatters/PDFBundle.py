@@ -0,0 +1,108 @@
+import hashlib
+
+from PyPDF2 import PdfFileReader
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+from .common import Bundle
+from .LetterheadForm import serialise
+
+class PDFBundle(Bundle):
+    """
+    Writes the pages of many PDFs into one, a document at a time.
+
+    The objects of each document are copied into the bundle as they
+    are, with streams left compressed, and only the references between
+    them are renumbered. Objects other than the pages and their
+    contents (fonts, the letterhead and the resources that refer to
+    them) are written once and shared by every document that has an
+    identical copy.
+
+    Only the document being added is held in memory. What's kept
+    between documents is the position of each object in the file, the
+    page numbers and the digests of the shared objects.
+    """
+    def __init__(self, fname):
+        super().__init__(fname)
+        self.offsets = [None] # By object number. There is no object 0.
+        self.shared = {}
+        self.kids = []
+        self.out.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self.pages = self.reserve()
+
+    def reserve(self):
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def write_object(self, number, data):
+        self.offsets[number] = self.out.tell()
+        self.out.write(b"%d 0 obj\n" % number + data + b"\nendobj\n")
+
+    def add(self, fname):
+        with open(fname, "rb") as f:
+            reader = PdfFileReader(f)
+            numbers = {}
+            for page in reader.pages:
+                number = self.reserve()
+                items = [(serialise(k), self.convert(v, numbers, k != '/Contents'))
+                         for k, v in page.items() if k != '/Parent']
+                items.append((b"/Parent", b"%d 0 R" % self.pages))
+                self.write_object(number, self.dictionary(items))
+                self.kids.append(number)
+
+    def convert(self, obj, numbers, share = True):
+        """
+        Serialises `obj`, a PyPDF2 object of the document being added,
+        writing the objects it refers to into the bundle first. `numbers`
+        maps the object numbers of the document to those of the bundle.
+        Referred objects are looked up in the shared ones if `share`.
+        """
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key in numbers:
+                if numbers[key] is None:
+                    # Refers back to an object still being converted.
+                    # It can't be shared, so give it a number now.
+                    numbers[key] = self.reserve()
+                return b"%d 0 R" % numbers[key]
+            numbers[key] = None
+            data = self.convert(obj.getObject(), numbers, share)
+            if numbers[key] is not None:
+                self.write_object(numbers[key], data)
+            elif share:
+                digest = hashlib.sha256(data).digest()
+                if digest not in self.shared:
+                    self.shared[digest] = self.reserve()
+                    self.write_object(self.shared[digest], data)
+                numbers[key] = self.shared[digest]
+            else:
+                numbers[key] = self.reserve()
+                self.write_object(numbers[key], data)
+            return b"%d 0 R" % numbers[key]
+        if isinstance(obj, StreamObject):
+            items = [(serialise(k), self.convert(v, numbers, share)) for k, v in obj.items() if k != '/Length']
+            items.append((b"/Length", b"%d" % len(obj._data)))
+            return self.dictionary(items) + b"\nstream\n" + obj._data + b"\nendstream"
+        if isinstance(obj, DictionaryObject):
+            return self.dictionary([(serialise(k), self.convert(v, numbers, share)) for k, v in obj.items()])
+        if isinstance(obj, ArrayObject):
+            return b"[" + b" ".join(self.convert(x, numbers, share) for x in obj) + b"]"
+        return serialise(obj)
+
+    @staticmethod
+    def dictionary(items):
+        return b"<<" + b"".join(b" " + k + b" " + v for k, v in items) + b" >>"
+
+    def close(self):
+        self.write_object(self.pages, self.dictionary([(b"/Type", b"/Pages"),
+                                                       (b"/Kids", b"[" + b" ".join(b"%d 0 R" % x for x in self.kids) + b"]"),
+                                                       (b"/Count", b"%d" % len(self.kids))]))
+        catalog = self.reserve()
+        self.write_object(catalog, self.dictionary([(b"/Type", b"/Catalog"),
+                                                    (b"/Pages", b"%d 0 R" % self.pages)]))
+        xref = self.out.tell()
+        self.out.write(b"xref\n0 %d\n0000000000 65535 f \n" % len(self.offsets))
+        for offset in self.offsets[1:]:
+            self.out.write(b"%010d 00000 n \n" % offset)
+        self.out.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                       % (len(self.offsets), catalog, xref))
+        super().close()
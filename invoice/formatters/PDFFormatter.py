@@ -1,26 +1,292 @@
 from decimal import Decimal
+import hashlib
 import io
+import itertools
+import logging
 
 from PyPDF2 import PdfFileWriter, PdfFileReader
+from PyPDF2.generic import ArrayObject, DictionaryObject, NameObject
+from PyPDF2.pdf import ContentStream, PageObject
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
 from reportlab.lib import colors
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table
+from reportlab.platypus.flowables import Flowable
+from reportlab.platypus.doctemplate import BaseDocTemplate, PageTemplate
+from reportlab.platypus.frames import Frame
 from reportlab.platypus.tables import TableStyle
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.rl_config import defaultPageSize
 from reportlab.lib.units import inch
 
-from .common import Formatter
+from .. import profiling
+from .common import Formatter, output_file
+from .LetterheadForm import LetterheadForm
+from .PDFBundle import PDFBundle
+from ..helpers import LRUCache
 
 # PAGE_HEIGHT=defaultPageSize[1]; PAGE_WIDTH=defaultPageSize[0]
 
+# Parsed letterhead pages and forms keyed on the digest of the
+# letterhead. Shared by all PDFFormatters in a process so that a batch
+# parses (and decompresses) each letterhead only once.
+LETTERHEAD_CACHE_SIZE = 16
+letterhead_cache = LRUCache(LETTERHEAD_CACHE_SIZE)
+form_cache = LRUCache(LETTERHEAD_CACHE_SIZE)
+
+def get_letterhead_page(letterhead, key = None):
+    """
+    Returns the first page of `letterhead`, which is the bytes of a PDF
+    as read from the database. io.BytesIO shares the buffer of a bytes
+    object until it's written to, so the reader works on the letterhead
+    in place without copying it.
+
+    `key` is the digest the letterhead is stored under. It's computed
+    if not given.
+    """
+    key = key or hashlib.sha256(letterhead).hexdigest()
+    page = letterhead_cache.get(key, lambda: PdfFileReader(io.BytesIO(letterhead)).getPage(0))
+    logging.getLogger("invoice").debug("Letterhead cache for %s: %d hits, %d misses",
+                                       key[:12], letterhead_cache.hits, letterhead_cache.misses)
+    return page
+
+def get_letterhead_form(letterhead, key = None):
+    """
+    Returns `letterhead` as a LetterheadForm or None if it can't be
+    converted into one, in which case it has to be merged instead.
+    """
+    key = key or hashlib.sha256(letterhead).hexdigest()
+    def create():
+        try:
+            return LetterheadForm(letterhead, "letterhead-" + key[:16])
+        except Exception:
+            logging.getLogger("invoice").warning("Can't draw letterhead %s directly. Merging it instead.",
+                                                 key[:12], exc_info = True)
+            return None
+    return form_cache.get(key, create)
+
+
+# The kinds of resource PyPDF2 merges by name
+RESOURCES = ("/ExtGState", "/Font", "/XObject", "/ColorSpace", "/Pattern", "/Shading", "/Properties")
+
+def rename_clashes(page, base):
+    """
+    Renames the resources of `page` that have the same name as a
+    different resource of `base`, the page it's about to be merged
+    onto, and the references to them in its contents. PyPDF2 would
+    rename them by appending a random uuid4(). Numbering them instead
+    means that merging the same pages always gives the same bytes.
+    """
+    # Copies, as the dictionaries may be shared with other pages
+    resources = DictionaryObject(page['/Resources'].getObject())
+    taken = base['/Resources'].getObject()
+    rename = {}
+    for kind in RESOURCES:
+        if kind not in resources or kind not in taken:
+            continue
+        names = DictionaryObject(resources[kind].getObject())
+        others = taken[kind].getObject()
+        for name in sorted(names):
+            if name in others and others.raw_get(name) != names.raw_get(name):
+                for i in itertools.count(1):
+                    new = NameObject("{}-{}".format(name, i))
+                    if new not in others and new not in names:
+                        break
+                names[new] = names.raw_get(name)
+                del names[name]
+                rename[name] = new
+        resources[NameObject(kind)] = names
+    if rename:
+        contents = ContentStream(page.getContents(), page.pdf)
+        for operands, operator in contents.operations:
+            for i, operand in enumerate(operands):
+                if isinstance(operand, NameObject):
+                    operands[i] = rename.get(operand, operand)
+        page[NameObject('/Contents')] = contents
+        page[NameObject('/Resources')] = resources
+
+
+class NumberedCanvas(canvas.Canvas):
+    """
+    A canvas that holds its pages back until the document is complete
+    so that, if there is more than one, they can be numbered "Page n of
+    N". Only the drawing operations of each page are kept.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pages = []
+
+    def showPage(self):
+        if self._code:
+            # One string takes far less memory than the many small ones
+            # the page is drawn with. ReportLab joins them like this.
+            self._code = ["\n".join(self._code)]
+        self.pages.append(dict(self.__dict__))
+        self._startPage()
+
+    def save(self):
+        count = len(self.pages)
+        for number in range(1, count + 1):
+            self.__dict__.update(self.pages[number - 1])
+            self.pages[number - 1] = None
+            if count > 1:
+                self.saveState()
+                self.setFont("Times-Roman", 9)
+                self.drawCentredString(self._pagesize[0] / 2, 0.5*inch, "Page {} of {}".format(number, count))
+                self.restoreState()
+            super().showPage()
+        super().save()
+
+class LetterheadDocTemplate(SimpleDocTemplate):
+    """
+    Lays out a document of any length over a letterhead (a
+    LetterheadForm or None), which is drawn on every page. On the first
+    page the content itself leaves room for the letterhead. Later pages
+    start `top` points further down and are headed with `continued`.
+    """
+    def __init__(self, filename, letterhead = None, top = 0, continued = "", **kwargs):
+        super().__init__(filename, **kwargs)
+        self.letterhead = letterhead
+        self.top = top
+        self.continued = continued
+
+    def first_page(self, canvas, doc):
+        if self.letterhead:
+            self.letterhead.draw(canvas)
+
+    def later_page(self, canvas, doc):
+        self.first_page(canvas, doc)
+        canvas.saveState()
+        canvas.setFont("Times-Italic", 10)
+        canvas.drawString(self.leftMargin, self.bottomMargin + self.height - self.top - 0.25*inch, self.continued)
+        canvas.restoreState()
+
+    def build(self, flowables):
+        self._calc()
+        first = Frame(self.leftMargin, self.bottomMargin, self.width, self.height, id = 'normal')
+        later = Frame(self.leftMargin, self.bottomMargin, self.width, self.height - self.top - 0.5*inch, id = 'later')
+        self.addPageTemplates([PageTemplate(id = 'First', frames = first, onPage = self.first_page, pagesize = self.pagesize),
+                               PageTemplate(id = 'Later', frames = later, onPage = self.later_page, pagesize = self.pagesize)])
+        BaseDocTemplate.build(self, flowables, canvasmaker = NumberedCanvas)
+
+def chunk_style(style, count, start, end):
+    """
+    Adapts the commands of `style`, written for a table of a header row
+    and `count` more rows, to a table of the header and rows `start` to
+    `end` (counting from 0 after the header).
+    """
+    rows = [0] + list(range(start + 1, end + 1))
+    ret = []
+    for name, (c0, r0), (c1, r1), *args in style.getCommands():
+        r0, r1 = [r + count + 1 if r < 0 else r for r in (r0, r1)]
+        selected = [idx for idx, row in enumerate(rows) if r0 <= row <= r1]
+        if selected:
+            ret.append((name, (c0, selected[0]), (c1, selected[-1])) + tuple(args))
+    return TableStyle(ret)
+
+class Cell(Paragraph):
+    """
+    A Paragraph in a table cell. A table measures its cells each time
+    it's laid out or split, so the lines a cell is broken into are kept
+    for the width they were broken for.
+    """
+    def wrap(self, availWidth, availHeight):
+        wrapped = self.__dict__.get('_wrapped')
+        if wrapped and wrapped[0] == availWidth:
+            _, self.width, self.height, self.blPara, self._wrapWidths = wrapped
+        else:
+            super().wrap(availWidth, availHeight)
+            self._wrapped = (availWidth, self.width, self.height, self.blPara, self._wrapWidths)
+        return self.width, self.height
+
+class PagedTable(Flowable):
+    """
+    A table with its header row repeated on every page it runs over.
+
+    ReportLab's Table copies and measures all of its remaining rows
+    each time it's split across a page, which takes time quadratic in
+    the number of rows. This gives it only about a page of rows at a
+    time, so long invoices and timesheets are laid out in linear time.
+    The part left after a split only keeps the rows not yet drawn.
+
+    `rows` is the header followed by the rows from `start` on of a
+    table of `count` rows (not counting the header), which is what
+    `style` is written for. If `cells` is given, the rows after the
+    header are converted into table cells with it as they're first
+    laid out (the first `converted` of them already are), so only
+    about a page of rows is in the form of cells at a time.
+    """
+    def __init__(self, rows, style, colWidths = None, hAlign = 'CENTER', cells = None,
+                 start = 0, chunk = 32, count = None, converted = 0):
+        super().__init__()
+        self.rows = rows
+        self.style = style
+        self.colWidths = colWidths
+        self.hAlign = hAlign
+        self.cells = cells
+        self.start = start
+        self.count = len(rows) - 1 if count is None else count
+        self.converted = converted if cells else len(rows) - 1
+        # Rows given to the first Table tried. Doubled until they
+        # overflow the space available or run out.
+        self.chunk = chunk
+        self._laid_out = None
+
+    def table(self, availWidth, availHeight):
+        """
+        Returns a Table of the rows from `start` that overflows
+        `availHeight` or holds all the remaining rows, with its size.
+        """
+        if self._laid_out and self._laid_out[0] == (availWidth, availHeight):
+            return self._laid_out[1]
+        remaining = len(self.rows) - 1
+        size = self.chunk
+        while True:
+            size = min(size, remaining)
+            for idx in range(self.converted + 1, size + 1):
+                self.rows[idx] = self.cells(self.rows[idx])
+            self.converted = max(self.converted, size)
+            table = Table(self.rows[:size + 1],
+                          colWidths = self.colWidths, repeatRows = 1, hAlign = self.hAlign,
+                          style = chunk_style(self.style, self.count, self.start, self.start + size))
+            width, height = table.wrap(availWidth, availHeight)
+            if height > availHeight or size == remaining:
+                self._laid_out = ((availWidth, availHeight), (table, width, height))
+                return table, width, height
+            size *= 2
+
+    def wrap(self, availWidth, availHeight):
+        self._table, self.width, self.height = self.table(availWidth, availHeight)
+        return self.width, self.height
+
+    def split(self, availWidth, availHeight):
+        table, _, height = self.table(availWidth, availHeight)
+        if height <= availHeight:
+            return [table]
+        parts = table.split(availWidth, availHeight)
+        if not parts:
+            return []
+        # The first part has the header and the rows that fit. The rest
+        # is laid out from the full list of rows again, trying a little
+        # more than a page of rows first.
+        first = parts[0]
+        fitted = first._nrows - 1
+        return [first, PagedTable(self.rows[:1] + self.rows[fitted + 1:], self.style, first._colWidths,
+                                  self.hAlign, self.cells, self.start + fitted, fitted + fitted // 4 + 1,
+                                  self.count, self.converted - fitted)]
+
+    def draw(self):
+        self._table.drawOn(self.canv, 0, 0)
 
 
 class PDFFormatter(Formatter):
-    def __init__(self, dir="generated"):
+    extension = ".pdf"
+    version = "4"
+    uses_letterhead = True
+
+    def __init__(self, dir="generated", cache = None, reproducible = True):
         self.styles = dict(name = ParagraphStyle("name", fontName = "Times-Roman", leading = 36,
                                                  fontSize = 30, alignment = TA_CENTER),
 
@@ -39,9 +305,9 @@ class PDFFormatter(Formatter):
                            regular = ParagraphStyle("to_address", fontName = "Times-Roman", leading = 12,
                                                     fontSize = 10, alignment = TA_RIGHT)
           )
-        super().__init__(dir)
+        super().__init__(dir, cache, reproducible)
 
-    def create_invoice_layer(self, invoice_data):
+    def create_invoice_layer(self, invoice_data, letterhead = None, out = None):
         client_address = invoice_data['client_address'].encode('utf-8').decode('unicode_escape')
         bank_details = invoice_data['bank_details'].encode('utf-8').decode('unicode_escape')
         date = invoice_data['date']
@@ -49,13 +315,14 @@ class PDFFormatter(Formatter):
         particulars = invoice_data['particulars']
         data_columns = invoice_data['columns']
         footers = invoice_data['footers']
-        taxes = invoice_data['taxes']
+        totals = invoice_data['totals']
         signatory = invoice_data['signatory']
         bill_unit = invoice_data['bill_unit']
 
         # create a new PDF with Reportlab
-        packet = io.BytesIO()
-        doc = SimpleDocTemplate(packet)
+        packet = io.BytesIO() if out is None else out
+        doc = LetterheadDocTemplate(packet, letterhead, 2*inch, "Invoice Number: {} (continued)".format(number),
+                                    invariant = self.reproducible)
 
         # Create top material with number and client address
         content = [Spacer(1, 2*inch)]
@@ -72,7 +339,7 @@ class PDFFormatter(Formatter):
 
         # Now the table headers
         headers = invoice_data['fields']
-        columns = [[Paragraph("<b>%s</b>"%x, self.styles['regular']) for x in headers]]
+        columns = [[Cell("<b>%s</b>"%x, self.styles['regular']) for x in headers]]
 
         list_style = TableStyle(
             [('LINEABOVE', (0,0), (-1,0), 1, colors.black),
@@ -85,33 +352,29 @@ class PDFFormatter(Formatter):
              ('LINEABOVE', (0,-1), (-1,-1), 1, colors.black),
          ])
 
-        total = Decimal(0)
         content.append(Spacer(1, 0.1*inch))
+        # Rows are copied rather than changed, so the same data can be
+        # rendered again (in a bundle or for the render cache key)
         for i in data_columns:
             if i[-1]:
-                total += Decimal(i[-1])
-                i[-1] = "{} {}".format(str(i[-1]), bill_unit)
-            columns.append(Paragraph(str(t), self.styles['regular']) for t in i)
-
-        extra_vals = dict(net_total = total)
-        for t,v in taxes.items():
-            n = total*Decimal(v)
-            extra_vals[t] = n.quantize(Decimal('0.01'))
-
-        extra_vals['gross_total'] = sum(extra_vals.values())
+                i = i[:-1] + ["{} {}".format(str(i[-1]), bill_unit)]
+            columns.append([str(t) for t in i])
 
         for i in footers:
             c1 =[] 
-            i[-1] = "{} {}".format(str(i[-1]), bill_unit)
+            i = i[:-1] + ["{} {}".format(str(i[-1]), bill_unit)]
             for j in i:
-                j = j.format(**extra_vals)
+                j = j.format(**totals)
                 if j.startswith("b:"):
-                    c1.append(Paragraph("<b>{}</b>".format(j.replace("b:","")), self.styles['regular']))
+                    c1.append("<b>{}</b>".format(j.replace("b:","")))
                 else:
-                    c1.append(Paragraph(str(j), self.styles['regular']))
+                    c1.append(str(j))
             columns.append(c1)
 
-        content.append(Table(columns, style = list_style))
+        content.append(PagedTable(columns, list_style,
+                                  cells = lambda row: [Cell(x, self.styles['regular']) for x in row]))
+        # The table lets go of its rows as they're drawn.
+        del columns
 
         content.append(Spacer(1, 0.5*inch))
         content.append(Paragraph("<b>Payment details:</b>", self.styles['to_address']))
@@ -126,28 +389,38 @@ class PDFFormatter(Formatter):
         doc.build(content)
         return packet
 
-    def add_to_letterhead(self, data, letterhead):
+    def add_to_letterhead(self, data, letterhead, letterhead_key = None):
         #move to the beginning of the StringIO buffer
         new_pdf = PdfFileReader(data)
-        # read your existing PDF
-        
-        existing_pdf = PdfFileReader(io.BytesIO(letterhead))
+        # The cached letterhead page is shared between documents so it
+        # must not be modified. Merge it and then the content onto a
+        # fresh page instead.
+        letterhead_page = get_letterhead_page(letterhead, letterhead_key)
         output = PdfFileWriter()
-        # add the "watermark" (which is the new pdf) on the existing page
-        page = existing_pdf.getPage(0)
-        page.mergePage(new_pdf.getPage(0))
-        output.addPage(page)
+        for content_page in new_pdf.pages:
+            page = PageObject.createBlankPage(None,
+                                              letterhead_page.mediaBox.getWidth(),
+                                              letterhead_page.mediaBox.getHeight())
+            page.mergePage(letterhead_page)
+            rename_clashes(content_page, page)
+            page.mergePage(content_page)
+            # Merging collects the procedure sets in a frozenset, whose
+            # order changes with string hashing from run to run.
+            resources = page['/Resources'].getObject()
+            resources[NameObject('/ProcSet')] = ArrayObject(sorted(resources['/ProcSet']))
+            output.addPage(page)
         return output
 
-    def create_timesheet_layer(self, timesheet_data):
+    def create_timesheet_layer(self, timesheet_data, letterhead = None, out = None):
         data = timesheet_data['data']
         client = timesheet_data['client']
         date = timesheet_data['date']
         employee = timesheet_data['emp']
         description = timesheet_data['desc']
         
-        packet = io.BytesIO()
-        doc = SimpleDocTemplate(packet)
+        packet = io.BytesIO() if out is None else out
+        doc = LetterheadDocTemplate(packet, letterhead, 1.25*inch, "Timesheet: {} (continued)".format(description),
+                                    invariant = self.reproducible)
 
         # Create top material with number and client address
         content = [Spacer(1, 1.25*inch)]
@@ -157,7 +430,7 @@ class PDFFormatter(Formatter):
         content.append(Paragraph("<b>Description: </b>{}".format(description), self.styles['to_address']))
         content.append(Spacer(1, 0.25*inch))
 
-        columns = [[Paragraph("<b>%s</b>"%x, self.styles['table_header']) for x in ["Day", "Date", "Hours"]]]
+        columns = [[Cell("<b>%s</b>"%x, self.styles['table_header']) for x in ["Day", "Date", "Hours"]]]
         list_style = TableStyle(
             [('LINEABOVE', (0,0), (-1,0), 1, colors.black),
              ('LINEBELOW', (0,0), (-1,0), 1, colors.black),
@@ -175,37 +448,58 @@ class PDFFormatter(Formatter):
         total = sum((Decimal(x[1]) for x in data), Decimal(0)).quantize(Decimal('0.01'))
         
         for date, hours in data:
-            columns.append([Paragraph(date.strftime('%a'), self.styles['table_small']),
-                            Paragraph(date.strftime('%d %b %Y'), self.styles['table_small']),
-                            Paragraph(str(Decimal(hours).quantize(Decimal('0.01'))), self.styles['table_small'])])
-        columns.append(['',
-                        Paragraph("<b>Total hours</b>", self.styles['table_small']), 
-                        Paragraph(str(total), self.styles['table_small'])])
+            columns.append([date.strftime('%a'), date.strftime('%d %b %Y'),
+                            str(Decimal(hours).quantize(Decimal('0.01')))])
+        columns.append(['', "<b>Total hours</b>", str(total)])
 
-        content.append(Table(columns, colWidths=[50, 150, 50], style = list_style, hAlign='LEFT'))
+        # The empty cell of the total row is left as it is
+        content.append(PagedTable(columns, list_style, colWidths=[50, 150, 50], hAlign='LEFT',
+                                  cells = lambda row: [Cell(x, self.styles['table_small']) if x else x for x in row]))
+        del columns
 
 
         doc.build(content)
         return packet
 
-    def generate_timesheet(self, timesheet, stdout = False, overwrite = False):
-        timesheet_layer = self.create_timesheet_layer(timesheet.serialise())
-        final_timesheet = self.add_to_letterhead(timesheet_layer, timesheet.template.letterhead)
+    def write_layer(self, create_layer, data, letterhead, fname, letterhead_key = None):
+        """
+        Writes the document created by `create_layer` from `data` onto
+        `letterhead`. The letterhead is drawn as the document is laid
+        out if possible, so the output doesn't have to be parsed again
+        and is written straight to the file. The time taken to write it
+        is then profiled as part of the layout.
+        """
+        with profiling.phase("merge"):
+            form = get_letterhead_form(letterhead, letterhead_key)
+        with profiling.phase("write"), output_file(fname) as outputStream:
+            if form:
+                with profiling.phase("layout"):
+                    create_layer(data, form, outputStream)
+            else:
+                with profiling.phase("layout"):
+                    layer = create_layer(data)
+                with profiling.phase("merge"):
+                    final = self.add_to_letterhead(layer, letterhead, letterhead_key)
+                final.write(outputStream)
+
+    def open_bundle(self, fname):
+        return PDFBundle(fname)
+
+    def write_timesheet(self, timesheet_data, letterhead, fname, letterhead_key = None):
+        self.write_layer(self.create_timesheet_layer, timesheet_data, letterhead, fname, letterhead_key)
+
+    def write_invoice(self, invoice_data, letterhead, fname, letterhead_key = None):
+        self.write_layer(self.create_invoice_layer, invoice_data, letterhead, fname, letterhead_key)
 
-        fname = self.gen_unique_filename(timesheet.file_name+".pdf", overwrite)
-        outputStream = open(fname, "wb")
-        final_timesheet.write(outputStream)
-        outputStream.close()
+    def generate_timesheet(self, timesheet, stdout = False, overwrite = False):
+        fname = self.gen_unique_filename(timesheet.file_name+self.extension, overwrite)
+        self.write_timesheet(timesheet.serialise(), timesheet.template.letterhead, fname,
+                             timesheet.template.letterhead_digest)
         return fname
         
 
     def generate_invoice(self, invoice, stdout = False, overwrite = False):
-        invoice_layer = self.create_invoice_layer(invoice.serialise())
-        final_invoice = self.add_to_letterhead(invoice_layer, invoice.template.letterhead)
-
-        fname = self.gen_unique_filename(invoice.file_name+".pdf", overwrite)
-        outputStream = open(fname, "wb")
-        final_invoice.write(outputStream)
-        outputStream.close()
+        fname = self.gen_unique_filename(invoice.file_name+self.extension, overwrite)
+        self.write_invoice(invoice.serialise(), invoice.template.letterhead, fname,
+                           invoice.template.letterhead_digest)
         return fname
-
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+class RenderCache:
+    """
+    A directory of previously generated documents named by a hash of
+    everything that went into them (the serialised document, the
+    template and letterhead, and the formatter and its version). When
+    it grows beyond `max_size` bytes, the least recently used files are
+    removed.
+    """
+    def __init__(self, dir, max_size):
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        self.base = dir
+        self.max_size = max_size
+        self.l = logging.getLogger("invoice")
+
+    @staticmethod
+    def key(*parts):
+        h = hashlib.sha256()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = json.dumps(part, sort_keys = True, default = str).encode("utf-8")
+            h.update(hashlib.sha256(part).digest())
+        return h.hexdigest()
+
+    def path(self, key, extension):
+        return os.path.join(self.base, key + extension)
+
+    def get(self, key, extension):
+        """
+        Returns the path of the cached document for `key` or None.
+        """
+        path = self.path(key, extension)
+        try:
+            os.utime(path) # Mark as recently used
+        except FileNotFoundError:
+            self.l.debug("Render cache miss %s", key)
+            return None
+        self.l.debug("Render cache hit %s", key)
+        return path
+
+    def put(self, key, extension, fname):
+        copy(fname, self.path(key, extension))
+
+    def put_text(self, key, extension, content):
+        path = self.path(key, extension)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    def prune(self):
+        entries = [x for x in os.scandir(self.base) if x.is_file()]
+        total = sum(x.stat().st_size for x in entries)
+        if total <= self.max_size:
+            return
+        for entry in sorted(entries, key = lambda x: x.stat().st_mtime):
+            total -= entry.stat().st_size
+            os.unlink(entry.path)
+            self.l.debug("Evicted %s from render cache", entry.name)
+            if total <= self.max_size:
+                break
+
+def copy(src, dest):
+    """
+    Copies `src` to `dest`. The copy is written next to `dest` and
+    renamed over it, so an existing `dest` is never seen half written.
+    Cache entries and the files in the output directory never share
+    their contents, so editing one can't change the other.
+    """
+    tmp = "{}.{}.tmp".format(dest, os.getpid())
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.digest()
+
+def same_file(a, b):
+    """
+    Whether `a` and `b` have the same contents.
+    """
+    if os.path.getsize(a) != os.path.getsize(b):
+        return False
+    return file_digest(a) == file_digest(b)
@@ -1,14 +1,17 @@
 from decimal import Decimal
 import io
 
-from .common import Formatter
+from .. import profiling
+from .common import Formatter, output_file
 
 # PAGE_HEIGHT=defaultPageSize[1]; PAGE_WIDTH=defaultPageSize[0]
 
 
 class TextFormatter(Formatter):
-    def __init__(self, dir="generated"):
-        super().__init__(dir)
+    extension = ".txt"
+
+    def __init__(self, dir="generated", cache = None, reproducible = True):
+        super().__init__(dir, cache, reproducible)
 
     def create_invoice_layer(self, invoice_data):
         client_address = invoice_data['client_address'].encode('utf-8').decode('unicode_escape')
@@ -18,7 +21,7 @@ class TextFormatter(Formatter):
         particulars = invoice_data['particulars']
         data_columns = invoice_data['columns']
         footers = invoice_data['footers']
-        taxes = invoice_data['taxes']
+        totals = invoice_data['totals']
         bill_unit = invoice_data['bill_unit']
 
         content = ["="*80]
@@ -59,27 +62,19 @@ class TextFormatter(Formatter):
         content.append(header_fmt_string.format(*headers))
         content.append(sep_fmt_string)
 
-        total = Decimal(0)
         for i in data_columns:
             if i[-1]:
-                total += Decimal(i[-1])
-                i[-1] = "{} {}".format(i[-1], bill_unit)
+                i = i[:-1] + ["{} {}".format(i[-1], bill_unit)]
             content.append(data_fmt_string.format(*[str(t).strip() for t in i]))
         content.append(sep_fmt_string)
 
-        extra_vals = dict(net_total = total)
-        for t,v in taxes.items():
-            n = total*Decimal(v)
-            extra_vals[t] = n.quantize(Decimal('0.01'))
-        extra_vals['gross_total'] = sum(extra_vals.values())
-
         for i in footers:
             c1 = []
-            i[-1] = "{} {}".format(i[-1], bill_unit)
+            i = i[:-1] + ["{} {}".format(i[-1], bill_unit)]
             for j in i:
                 if j.startswith("b:"):
                     j = j.replace("b:", "")
-                j = j.format(**extra_vals)
+                j = j.format(**totals)
                 c1.append(j)
             content.append(data_fmt_string.format(*c1))
         content.append(sep_fmt_string)
@@ -132,25 +127,48 @@ class TextFormatter(Formatter):
         content.append("="*80)
         return "\n".join(content)
 
+    def layer(self, kind, document, create_layer):
+        """
+        Returns the text for `document`, from the render cache if
+        possible.
+        """
+        data = document.serialise()
+        if not self.cache:
+            return create_layer(data)
+        key = self.cache_key(kind, self.template_key(document.template), data)
+        cached = self.cache.get(key, self.extension)
+        if cached:
+            with open(cached) as f:
+                return f.read()
+        content = create_layer(data)
+        self.cache.put_text(key, self.extension, content)
+        self.cache.prune()
+        return content
+
+    def write_timesheet(self, timesheet_data, letterhead, fname, letterhead_key = None):
+        with profiling.phase("layout"):
+            content = self.create_timesheet_layer(timesheet_data)
+        with profiling.phase("write"), output_file(fname, "w") as f:
+            f.write(content)
+
+    def write_invoice(self, invoice_data, letterhead, fname, letterhead_key = None):
+        with profiling.phase("layout"):
+            content = self.create_invoice_layer(invoice_data)
+        with profiling.phase("write"), output_file(fname, "w") as f:
+            f.write(content)
+
     def generate_timesheet(self, timesheet, stdout = False, overwrite = False):
-        timesheet_data = self.create_timesheet_layer(timesheet.serialise())
         if stdout:
-            fname = timesheet_data
-        else:
-            fname = self.gen_unique_filename(timesheet.file_name+".txt", overwrite)
-            with open(fname, "w") as f:
-                f.write(timesheet_data)
+            return self.layer("timesheet", timesheet, self.create_timesheet_layer)
+        fname = self.gen_unique_filename(timesheet.file_name+self.extension, overwrite)
+        self.write_timesheet(timesheet.serialise(), None, fname)
         return fname
         
 
 
     def generate_invoice(self, invoice, stdout=False, overwrite = False):
-        invoice_data = self.create_invoice_layer(invoice.serialise())
         if stdout:
-            fname = invoice_data
-        else:
-            fname = self.gen_unique_filename(invoice.file_name+".txt", overwrite)
-            with open(fname, "w") as f:
-                f.write(invoice_data)
+            return self.layer("invoice", invoice, self.create_invoice_layer)
+        fname = self.gen_unique_filename(invoice.file_name+self.extension, overwrite)
+        self.write_invoice(invoice.serialise(), None, fname)
         return fname
-
@@ -1,9 +1,26 @@
 from collections import OrderedDict
+from collections.abc import Mapping
+import importlib
 
-from .PDFFormatter import PDFFormatter
-from .TextFormatter import TextFormatter
+class Formatters(Mapping):
+    """
+    Maps format names to formatter classes. The formatter modules (and
+    ReportLab and PyPDF2 with them) are only imported when a class is
+    looked up.
+    """
+    def __init__(self, names):
+        self.names = names
 
-def get_formatters():
-    return OrderedDict([('pdf',  PDFFormatter),
-                        ('txt',  TextFormatter)])
+    def __getitem__(self, name):
+        module = importlib.import_module("." + self.names[name], __name__)
+        return getattr(module, self.names[name])
+
+    def __iter__(self):
+        return iter(self.names)
 
+    def __len__(self):
+        return len(self.names)
+
+def get_formatters():
+    return Formatters(OrderedDict([('pdf',  'PDFFormatter'),
+                                   ('txt',  'TextFormatter')]))
@@ -1,22 +1,297 @@
+import abc
+import contextlib
 import itertools
+import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
+import traceback
 
-class Formatter:
-    def __init__(self, dir="generated"):
+from .. import __version__
+from .. import profiling
+from .RenderCache import copy, same_file
+
+# Per process formatter used by the worker pool in Formatter.generate_batch
+_worker = None
+
+# Buffer size of the files documents are written to
+OUTPUT_BUFFER_SIZE = 256 * 1024
+
+def _init_worker(formatter_class, dir, reproducible, letterheads, profile):
+    global _worker
+    _worker = formatter_class(dir, reproducible = reproducible)
+    _worker.letterheads = letterheads
+    if profile is not None:
+        profiling.start(**profile)
+
+def _write(formatter, job, letterhead):
+    """
+    Writes the document of `job` with `formatter`. Returns the
+    traceback if that failed, so that the parent can say which document
+    it was and carry on with the others, and None otherwise.
+    """
+    kind, letterhead_key, data, fname = job
+    try:
+        formatter.write(kind, data, letterhead_key, letterhead, fname)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+def _render(job):
+    error = _write(_worker, job, _worker.letterheads[job[1]])
+    # The timings of the job, if profiling, for the parent to add up
+    return error, profiling.collect()
+
+
+def temporary_name(fname, pid = None):
+    """
+    The name output_file() writes `fname` under in the process `pid`
+    (this one by default) until it's complete.
+    """
+    return "{}.{}.tmp".format(fname, os.getpid() if pid is None else pid)
+
+@contextlib.contextmanager
+def output_file(fname, mode = "wb"):
+    """
+    Opens a temporary file next to `fname` to write a document to and
+    renames it to `fname` once it's complete. Readers see either the
+    old file or the new one, never a partly written one. If writing
+    fails, the temporary file is removed and `fname` is left alone.
+    """
+    tmp = temporary_name(fname)
+    try:
+        with open(tmp, mode, buffering = OUTPUT_BUFFER_SIZE) as f:
+            yield f
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class Bundle:
+    """
+    Writes many documents into the one file `fname`, one after the
+    other, separated by form feeds.
+    """
+    def __init__(self, fname):
+        self.output = output_file(fname)
+        self.out = self.output.__enter__()
+        self.count = 0
+
+    def add(self, fname):
+        if self.count:
+            self.out.write(b"\f")
+        with open(fname, "rb") as f:
+            shutil.copyfileobj(f, self.out)
+        self.count += 1
+
+    def close(self):
+        self.output.__exit__(None, None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.output.__exit__(*exc)
+
+
+class Formatter(metaclass = abc.ABCMeta):
+    extension = ""
+    # Bump this when a change to the formatter alters its output so
+    # that documents in the render cache are regenerated.
+    version = "1"
+    # Whether the output depends on the template's letterhead. If not,
+    # the letterhead isn't loaded from the database at all.
+    uses_letterhead = False
+
+    def __init__(self, dir="generated", cache = None, reproducible = True):
         if not os.path.exists(dir):
             os.makedirs(dir)
         self.base = dir
+        self.cache = cache
+        # Whether the same document always produces the same bytes.
+        # Otherwise the output may carry the time it was generated.
+        self.reproducible = reproducible
+        self.l = logging.getLogger("invoice")
 
-    def gen_unique_filename(self, name, overwrite):
+    def gen_unique_filename(self, name, overwrite, reserved = ()):
         full_name = os.path.join(self.base, name)
-        if overwrite:
+        if overwrite and full_name not in reserved:
             return full_name
-        if not os.path.exists(full_name):
+        if not os.path.exists(full_name) and full_name not in reserved:
             return full_name
         else:
             basename, extension = os.path.splitext(os.path.basename(name))
             for i in itertools.count(1):
                 nname = os.path.join(self.base, "{}_({}){}".format(basename, i, extension))
-                if not os.path.exists(nname):
+                if not os.path.exists(nname) and nname not in reserved:
                     return nname
 
+    @abc.abstractmethod
+    def write_invoice(self, invoice_data, letterhead, fname, letterhead_key = None):
+        """
+        Writes the serialised invoice `invoice_data` to `fname`.
+        """
+
+    @abc.abstractmethod
+    def write_timesheet(self, timesheet_data, letterhead, fname, letterhead_key = None):
+        """
+        Writes the serialised timesheet `timesheet_data` to `fname`.
+        """
+
+    def write(self, kind, data, letterhead_key, letterhead, fname):
+        if kind == "invoice":
+            self.write_invoice(data, letterhead, fname, letterhead_key)
+        else:
+            self.write_timesheet(data, letterhead, fname, letterhead_key)
+
+    def open_bundle(self, fname):
+        return Bundle(fname)
+
+    def letterhead_key(self, template):
+        """
+        The digest of the letterhead of `template` if this formatter
+        uses it. Letterheads are stored by digest, so this identifies
+        the letterhead without loading it.
+        """
+        return template.letterhead_digest if self.uses_letterhead else None
+
+    def get_letterhead(self, template):
+        return template.letterhead if self.uses_letterhead else None
+
+    def template_key(self, template):
+        return self.cache.key(self.letterhead_key(template), template.template)
+
+    def cache_key(self, kind, template_key, data):
+        """
+        The render cache key for a document. `template_key` is the
+        result of template_key() for the document's template.
+        """
+        return self.cache.key(kind, self.__class__.__name__, self.version, __version__, self.reproducible,
+                              template_key, data)
+
+    def generate_batch(self, kind, documents, overwrite = False, jobs = 1):
+        """
+        Renders a list of invoices or timesheets (`kind` is "invoice"
+        or "timesheet") and yields the generated file names in the
+        same order as `documents`.
+
+        All database access (serialise() and the letterheads) happens
+        here in the parent. If `jobs` is more than 1, the rendering
+        itself is fanned out to a pool of worker processes. Each
+        worker receives the letterheads once when it starts and the
+        individual jobs only refer to them by digest. Letterheads are
+        only loaded for documents that have to be rendered.
+
+        If the formatter has a render cache, documents found in it are
+        not rendered again. When the file in the output directory
+        already has the cached contents, it's left alone.
+
+        A document that fails to render is logged with its file name
+        and the others are rendered regardless. RuntimeError is raised
+        once they're done.
+        """
+        letterheads = {}
+        template_keys = {}
+        batch = []
+        reserved = set()
+        for position, document in enumerate(documents, 1):
+            name = document.file_name + self.extension
+            # Documents can share a name until it's made unique, so
+            # they're profiled by their position as well
+            profiled = "#{} {}".format(position, name)
+            with profiling.document(profiled):
+                template = document.template
+                if self.cache and template.name not in template_keys:
+                    template_keys[template.name] = self.template_key(template)
+                with profiling.phase("serialise"):
+                    data = document.serialise()
+                key = cached = job = None
+                if self.cache:
+                    key = self.cache_key(kind, template_keys[template.name], data)
+                    cached = self.cache.get(key, self.extension)
+
+                target = os.path.join(self.base, name)
+                if cached and target not in reserved and os.path.exists(target) and same_file(cached, target):
+                    self.l.debug("%s is unchanged", target)
+                    fname = target
+                else:
+                    fname = self.gen_unique_filename(name, overwrite, reserved)
+                    if cached:
+                        copy(cached, fname)
+                    else:
+                        letterhead_key = self.letterhead_key(template)
+                        if letterhead_key not in letterheads:
+                            letterheads[letterhead_key] = self.get_letterhead(template)
+                        job = (kind, letterhead_key, data, fname)
+                reserved.add(fname)
+                batch.append((fname, key, job, profiled))
+
+        pending = [job for _, _, job, _ in batch if job]
+        if jobs <= 1 or len(pending) <= 1:
+            rendered = ((_write(self, job, letterheads[job[1]]), None) for job in pending)
+            yield from self._finish_batch(batch, rendered)
+        else:
+            chunksize = max(1, len(pending) // (jobs * 4))
+            children = set(multiprocessing.active_children())
+            pool = multiprocessing.Pool(jobs, _init_worker, (self.__class__, self.base, self.reproducible, letterheads,
+                                                             profiling.options()))
+            workers = [x.pid for x in set(multiprocessing.active_children()) - children]
+            try:
+                yield from self._finish_batch(batch, pool.imap(_render, pending, chunksize))
+            except BaseException:
+                # Stopped with documents still to render, by an error here
+                # or by the caller. Terminating the workers skips the clean
+                # up in output_file(), so what they were writing is removed
+                # here.
+                pool.terminate()
+                pool.join()
+                for _, _, _, fname in pending:
+                    for pid in workers:
+                        tmp = temporary_name(fname, pid)
+                        if os.path.exists(tmp):
+                            os.unlink(tmp)
+                raise
+            pool.close()
+            pool.join()
+
+    def generate_bundle(self, kind, documents, fname, jobs = 1):
+        """
+        Renders `documents` like generate_batch() but writes them all,
+        in order, into the one file `fname`. Each document is rendered
+        into a temporary directory and added to the bundle as soon as
+        it's ready.
+        """
+        with tempfile.TemporaryDirectory(prefix = "invoice-bundle-") as tmp:
+            formatter = self.__class__(tmp, self.cache, self.reproducible)
+            with self.open_bundle(fname) as bundle:
+                for name in formatter.generate_batch(kind, documents, True, jobs):
+                    with profiling.phase("bundle"):
+                        bundle.add(name)
+                    os.unlink(name)
+        return fname
+
+    def _finish_batch(self, batch, rendered):
+        failed = []
+        for fname, key, job, profiled in batch:
+            if job:
+                with profiling.document(profiled):
+                    error, collected = next(rendered)
+                    profiling.merge(collected)
+                if error:
+                    self.l.critical("Couldn't render %s: %s", fname, error.strip().splitlines()[-1])
+                    self.l.debug("%s", error)
+                    failed.append(fname)
+                    continue
+                if self.cache:
+                    self.cache.put(key, self.extension, fname)
+            yield fname
+        if self.cache:
+            self.cache.prune()
+        if failed:
+            raise RuntimeError("{} of {} documents couldn't be rendered".format(len(failed), len(batch)))
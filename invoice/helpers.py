@@ -1,13 +1,13 @@
+from collections import OrderedDict
 import functools
 import os
-import pkg_resources
 import subprocess
 import tempfile
 import textwrap
 
-from alembic.config import Config
-
 def get_alembic_config(url):
+    # Alembic is slow to import and only needed by init and db
+    from alembic.config import Config
     alembic_cfg = Config()
     alembic_cfg.set_main_option('sqlalchemy.url', "sqlite:///{}".format(url))
     script_location = get_package_file('migrations')
@@ -15,7 +15,9 @@ def get_alembic_config(url):
     return alembic_cfg
 
 def get_package_file(fname):
-    return  pkg_resources.resource_filename("invoice", fname)
+    # The package is installed unzipped (zip_safe = False) so its files
+    # can be found relative to this module.
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), fname)
 
 def wrap(ip, extra_indent):
     return textwrap.fill(ip, subsequent_indent = " "*extra_indent)
@@ -37,6 +39,38 @@ def memoise(fn):
     return memoised_fn
 
 
+class LRUCache:
+    """
+    A small bounded mapping which evicts the least recently used entry
+    once it holds more than `size` items. Keeps hit and miss counts so
+    that callers can report how effective it was.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    def get(self, key, factory):
+        """
+        Returns the value cached under `key`, calling `factory()` to
+        create (and cache) it if it isn't present.
+        """
+        try:
+            value = self.entries.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = factory()
+            self.misses += 1
+            if len(self.entries) >= self.size:
+                self.entries.popitem(last = False)
+        self.entries[key] = value
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+
 def get_from_file(init_string='', delete = False):
     f = tempfile.NamedTemporaryFile(mode = "w", delete = False)
     fname = f.name
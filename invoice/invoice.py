@@ -8,6 +8,8 @@ from sqlalchemy.orm.exc import NoResultFound
 from . import model
 from . import commands
 from . import formatters
+from . import queries
+from . import profiling
 from . import __version__
 
 l = None
@@ -35,6 +37,9 @@ def parse_args():
     parser.add_argument("-d", "--debug", dest = "debug", action = "store_true", default = False, help = "Turn on debugging output")
     parser.add_argument("-o", "--output", dest = "output", default = argparse.SUPPRESS, help = "Directory to output generated files")
     parser.add_argument("-v", "--version", dest = "version", action = "store_true", default = False, help = "Display software and db version and quit.")
+    parser.add_argument("--profile", action = "store_true", default = False, help = "Print where the time went (SQL, serialising, layout, merging and writing), by document, and the peak memory used.")
+    parser.add_argument("--profile-memory", action = "store_true", default = False, help = "Also trace the memory Python allocates with tracemalloc. Much slower. Implies --profile.")
+    parser.add_argument("--profile-stats", metavar = "FILE", help = "Also write cProfile statistics to this file for pstats. Implies --profile.")
 
     subparsers = parser.add_subparsers(title="Commands", dest="command", help = "Commands available")
 
@@ -49,11 +54,14 @@ def parse_args():
     db_info_parser = db_subparsers.add_parser("info", help="Summarise database status")
     db_update_parser = db_subparsers.add_parser("update", help="Update the database to the latest version")
     db_update_parser = db_subparsers.add_parser("migrate", help="Create database migrations (not needed for end users)")
+    db_explain_parser = db_subparsers.add_parser("explain", help="Print the SQLite query plans of the built in queries")
+    db_load_parser = db_subparsers.add_parser("load", help="Replace the contents of the database with a dump written by 'summary --dump'")
+    db_load_parser.add_argument("dump", help = "Dump file to load. Use - to read it from standard input")
 
     summary_parser = subparsers.add_parser("summary", help="Print a summary of the database contents")
     summary_parser.add_argument("-c", "--chronological", action="store_true", default=argparse.SUPPRESS, help="Order by date rather than id")
     summary_parser.add_argument("-v", "--verbose", action="store_true", default=False, help="Print detailed summary")
-    summary_parser.add_argument("-d", "--dump", action = "store_true", default = False, help = "Dump the entire database in a format that can be imported") #TBD
+    summary_parser.add_argument("-d", "--dump", action = "store_true", default = False, help = "Dump the entire database in a format that can be loaded with 'db load'")
 
 
     timesheet_parser = subparsers.add_parser("timesheet", help="Manage timesheets")
@@ -91,7 +99,16 @@ def parse_args():
     timesheet_import_parser.add_argument("-c", "--client", required = True, help="Client name")
     timesheet_import_parser.add_argument("-s", "--description", required = True, help="Description of timesheet")
     timesheet_import_parser.add_argument("-t", "--template", required = True, help="Template to use")
-    timesheet_import_parser.add_argument("timesheet")
+    timesheet_import_parser.add_argument("-j", "--jobs",
+                                         type = int,
+                                         default = argparse.SUPPRESS,
+                                         help = "Number of processes to parse the files with. Default is 1.")
+    timesheet_import_parser.add_argument("-i", "--incremental",
+                                         action = "store_true",
+                                         default = False,
+                                         help = "Only read what was added to files imported this way before and add it to their timesheets.")
+    timesheet_import_parser.add_argument("timesheet", nargs = "+",
+                                         help = "Org files to import, one timesheet each. Directories are searched for .org files.")
 
     timesheet_parse_parser = timesheet_subparsers.add_parser("parse", help="Parse and print a timesheet")
     timesheet_parse_parser.add_argument("timesheet", help = "Timesheet file")
@@ -119,6 +136,18 @@ def parse_args():
                                            action="store_true",
                                            default = argparse.SUPPRESS,
                                            help = "Overwrite existing generated files.")
+    timesheet_generate_parser.add_argument("-j", "--jobs",
+                                           type = int,
+                                           default = argparse.SUPPRESS,
+                                           help = "Number of processes to render timesheets with. Default is 1.")
+    timesheet_generate_parser.add_argument("--bundle",
+                                           metavar = "FILE",
+                                           help = "Write all the timesheets into this one file instead of one file each.")
+    timesheet_generate_parser.add_argument("--no-reproducible",
+                                           dest = "reproducible",
+                                           action = "store_false",
+                                           default = argparse.SUPPRESS,
+                                           help = "Stamp PDFs with the time they were generated. By default the same timesheet always gives identical files.")
     
 
 
@@ -243,6 +272,29 @@ def parse_args():
     tag_group = invoice_edit_parser.add_mutually_exclusive_group()
     tag_group.add_argument("-a", "--add-tags", action = "append", help = "Tags to add to the invoice. Can be specified multiple times.")
     tag_group.add_argument("-r", "--replace-tags", action = "append", help = "Tags attached to the invoice will be replaced by these. Can be specified multiple times.")
+
+    invoice_report_parser = invoice_subparsers.add_parser("report", help = "Report amounts billed and hours worked")
+    invoice_report_parser.add_argument("-g", "--group-by",
+                                       choices = queries.REPORT_GROUPS,
+                                       default = "month",
+                                       help = "How to group the report. Default is %(default)s")
+    invoice_report_parser.add_argument("-f", "--from",
+                                       help = "Only include invoices since this date (10/Aug/2010)")
+    invoice_report_parser.add_argument("-t", "--to",
+                                       help = "Only include invoices till this date (10/Aug/2010)")
+    invoice_report_parser.add_argument("-c", "--client",
+                                       help = "Only include invoices for this client")
+    invoice_report_parser.add_argument("-a", "--all",
+                                       action="store_true",
+                                       default=False,
+                                       help = "Include cancelled invoices")
+    invoice_report_parser.add_argument("--format", dest = "report_format",
+                                       choices = ["txt", "csv", "json"],
+                                       default = "txt",
+                                       help = "Output format. Default is %(default)s")
+
+    invoice_recompute_parser = invoice_subparsers.add_parser("recompute", help = "Recompute the stored totals of invoices")
+    invoice_recompute_parser.add_argument("-t", "--template", help = "Only recompute invoices using this template")
     
     invoice_generate_parser = invoice_subparsers.add_parser("generate", help = "Generate an invoice")
     invoice_generate_parser.add_argument("-i", "--id",
@@ -265,6 +317,18 @@ def parse_args():
                                          action="store_true",
                                          default = argparse.SUPPRESS,
                                          help = "Overwrite existing generated files.")
+    invoice_generate_parser.add_argument("-j", "--jobs",
+                                         type = int,
+                                         default = argparse.SUPPRESS,
+                                         help = "Number of processes to render invoices with. Default is 1.")
+    invoice_generate_parser.add_argument("--bundle",
+                                         metavar = "FILE",
+                                         help = "Write all the invoices into this one file instead of one file each.")
+    invoice_generate_parser.add_argument("--no-reproducible",
+                                         dest = "reproducible",
+                                         action = "store_false",
+                                         default = argparse.SUPPRESS,
+                                         help = "Stamp PDFs with the time they were generated. By default the same invoice always gives identical files.")
 
 
 
@@ -309,7 +373,14 @@ def main():
     args = parse_args()
     setup_logging(args.debug)
     l.debug("Invoice version '%s'", __version__)
-    dispatch(args)
+    if args.profile or args.profile_memory or args.profile_stats:
+        profiling.start(args.profile_stats, args.profile_memory)
+        try:
+            dispatch(args)
+        finally:
+            profiling.stop()
+    else:
+        dispatch(args)
 
 if __name__ == '__main__':
     main()
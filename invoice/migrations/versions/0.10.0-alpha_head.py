@@ -0,0 +1,33 @@
+"""head
+
+Revision ID: 0.10.0-alpha
+Revises: 0.9.0-alpha
+Create Date: 2026-10-18 16:48:13.902514
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0.10.0-alpha'
+down_revision = '0.9.0-alpha'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timesheet_sources',
+                    sa.Column('path', sa.String(), nullable=False),
+                    sa.Column('timesheet_id', sa.Integer(), nullable=False),
+                    sa.Column('offset', sa.Integer(), nullable=False),
+                    sa.Column('checksum', sa.String(length=64), nullable=False),
+                    sa.Column('day', sa.Date(), nullable=True),
+                    sa.Column('size', sa.Integer(), nullable=False),
+                    sa.Column('inode', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['timesheet_id'], ['timesheets.id'], ),
+                    sa.PrimaryKeyConstraint('path'))
+
+
+def downgrade():
+    op.drop_table('timesheet_sources')
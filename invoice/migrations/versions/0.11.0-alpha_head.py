@@ -0,0 +1,75 @@
+"""head
+
+Revision ID: 0.11.0-alpha
+Revises: 0.10.0-alpha
+Create Date: 2026-10-18 17:52:40.118306
+
+"""
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0.11.0-alpha'
+down_revision = '0.10.0-alpha'
+branch_labels = None
+depends_on = None
+
+templates = sa.table('templates',
+                     sa.column('name', sa.String),
+                     sa.column('letterhead', sa.LargeBinary),
+                     sa.column('letterhead_digest', sa.String))
+
+letterheads = sa.table('letterheads',
+                       sa.column('digest', sa.String),
+                       sa.column('data', sa.LargeBinary))
+
+def upgrade():
+    op.create_table('letterheads',
+                    sa.Column('digest', sa.String(length=64), nullable=False),
+                    sa.Column('data', sa.BLOB(length=1048576), nullable=False),
+                    sa.PrimaryKeyConstraint('digest'))
+    op.add_column('templates', sa.Column('letterhead_digest', sa.String(length=64), nullable=True))
+
+    # One template at a time so that only one letterhead is in memory.
+    conn = op.get_bind()
+    digests = set()
+    names = [x for x, in conn.execute(sa.select([templates.c.name])).fetchall()]
+    for name in names:
+        data = conn.execute(sa.select([templates.c.letterhead])
+                            .where(templates.c.name == name)).scalar()
+        if not data:
+            continue
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in digests:
+            conn.execute(letterheads.insert().values(digest = digest, data = data))
+            digests.add(digest)
+        conn.execute(templates.update()
+                     .where(templates.c.name == name)
+                     .values(letterhead_digest = digest))
+
+    with op.batch_alter_table('templates') as batch_op:
+        batch_op.drop_column('letterhead')
+        batch_op.create_foreign_key('fk_templates_letterhead_digest', 'letterheads',
+                                    ['letterhead_digest'], ['digest'])
+
+
+def downgrade():
+    with op.batch_alter_table('templates') as batch_op:
+        batch_op.add_column(sa.Column('letterhead', sa.BLOB(length=1048576), nullable=True))
+
+    conn = op.get_bind()
+    digests = [x for x, in conn.execute(sa.select([letterheads.c.digest])).fetchall()]
+    for digest in digests:
+        data = conn.execute(sa.select([letterheads.c.data])
+                            .where(letterheads.c.digest == digest)).scalar()
+        conn.execute(templates.update()
+                     .where(templates.c.letterhead_digest == digest)
+                     .values(letterhead = data))
+
+    with op.batch_alter_table('templates') as batch_op:
+        batch_op.drop_constraint('fk_templates_letterhead_digest', type_='foreignkey')
+        batch_op.drop_column('letterhead_digest')
+    op.drop_table('letterheads')
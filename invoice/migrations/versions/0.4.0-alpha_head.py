@@ -0,0 +1,50 @@
+"""head
+
+Revision ID: 0.4.0-alpha
+Revises: 0.3.1-alpha
+Create Date: 2026-10-18 10:12:41.315207
+
+"""
+from collections import OrderedDict
+from decimal import Decimal
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0.4.0-alpha'
+down_revision = '0.3.1-alpha'
+branch_labels = None
+depends_on = None
+
+def compile_template(source):
+    # invoice.model.compile_template() as of this revision. A copy so
+    # that later changes to it don't change what this migration does.
+    import yaml
+    data = yaml.safe_load(source)
+    fields = [x.strip() for x in data['rows'].strip().strip("|").split("|")]
+    footer_rows = data['footer'].strip().split("\n")
+    footers = [[t.strip() for t in x.strip("|").split("|")] for x in  footer_rows]
+    taxes = OrderedDict((k, str(Decimal(v))) for k,v in (data.get('taxes') or {}).items())
+    return json.dumps(OrderedDict([("fields", fields),
+                                   ("footers", footers),
+                                   ("taxes", taxes)]))
+
+templates = sa.table('templates',
+                     sa.column('name', sa.String),
+                     sa.column('template', sa.String),
+                     sa.column('compiled', sa.String))
+
+def upgrade():
+    op.add_column('templates', sa.Column('compiled', sa.String()))
+    conn = op.get_bind()
+    for name, source in conn.execute(sa.select([templates.c.name, templates.c.template])).fetchall():
+        conn.execute(templates.update()
+                     .where(templates.c.name == name)
+                     .values(compiled = compile_template(source)))
+
+
+def downgrade():
+    op.drop_column('templates', 'compiled')
@@ -0,0 +1,38 @@
+"""head
+
+Revision ID: 0.5.0-alpha
+Revises: 0.4.0-alpha
+Create Date: 2026-10-18 11:02:17.448913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0.5.0-alpha'
+down_revision = '0.4.0-alpha'
+branch_labels = None
+depends_on = None
+
+# SQLite creates the unique constraint on disp_number without a name
+naming_convention = {"uq": "uq_%(table_name)s_%(column_0_name)s"}
+
+def upgrade():
+    op.create_table('invoice_counters',
+                    sa.Column('account_id', sa.Integer(), nullable=False),
+                    sa.Column('year', sa.Integer(), nullable=False),
+                    sa.Column('last_number', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+                    sa.PrimaryKeyConstraint('account_id', 'year'))
+
+    # Numbers are now only unique per account (and year). Databases
+    # upgraded through 0.3.1-alpha never had the constraint.
+    inspector = sa.inspect(op.get_bind())
+    if any(uc['column_names'] == ['disp_number'] for uc in inspector.get_unique_constraints('invoices')):
+        with op.batch_alter_table('invoices', naming_convention=naming_convention) as batch_op:
+            batch_op.drop_constraint('uq_invoices_disp_number', type_='unique')
+
+
+def downgrade():
+    op.drop_table('invoice_counters')
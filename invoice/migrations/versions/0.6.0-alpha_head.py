@@ -0,0 +1,33 @@
+"""head
+
+Revision ID: 0.6.0-alpha
+Revises: 0.5.0-alpha
+Create Date: 2026-10-18 11:47:52.106324
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0.6.0-alpha'
+down_revision = '0.5.0-alpha'
+branch_labels = None
+depends_on = None
+
+indexes = [('ix_invoices_date', 'invoices', ['date']),
+           ('ix_invoices_client_id_date', 'invoices', ['client_id', 'date']),
+           ('ix_timesheets_date', 'timesheets', ['date']),
+           ('ix_timesheets_client_id_date', 'timesheets', ['client_id', 'date']),
+           ('ix_timesheets_employee_date', 'timesheets', ['employee', 'date']),
+           ('ix_invoice_tag_invoice_id_tag_name', 'invoice_tag', ['invoice_id', 'tag_name']),
+           ('ix_invoice_tag_tag_name_invoice_id', 'invoice_tag', ['tag_name', 'invoice_id'])]
+
+def upgrade():
+    for name, table, columns in indexes:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(indexes):
+        op.drop_index(name, table)
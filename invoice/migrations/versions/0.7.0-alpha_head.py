@@ -0,0 +1,91 @@
+"""head
+
+Revision ID: 0.7.0-alpha
+Revises: 0.6.0-alpha
+Create Date: 2026-10-18 13:05:27.448913
+
+"""
+from decimal import Decimal, InvalidOperation
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0.7.0-alpha'
+down_revision = '0.6.0-alpha'
+branch_labels = None
+depends_on = None
+
+# Copies of invoice.model.Money and invoice.model.parse_content() as of
+# this revision, so that later changes to them don't change what this
+# migration does.
+
+class Money(sa.types.TypeDecorator):
+    impl = sa.Integer
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(Decimal(value).quantize(Decimal('0.01')).scaleb(2))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Decimal(value).scaleb(-2)
+
+def parse_content(content):
+    ret = []
+    for i in content.split("\n"):
+        i = i.strip()
+        if i.startswith("#") or not i:
+            continue
+        fields = i.strip().strip("|").split("|")
+        if not any(x.strip() for x in fields):
+            continue
+        fields[-1] = Decimal(fields[-1]).quantize(Decimal('0.01'))
+        ret.append(fields)
+    return ret
+
+invoices = sa.table('invoices',
+                    sa.column('id', sa.Integer),
+                    sa.column('content', sa.String))
+
+def upgrade():
+    # The content is parsed before the schema is touched. SQLite can't
+    # roll back a half done migration, so one that stops here can
+    # simply be run again.
+    conn = op.get_bind()
+    lines = []
+    bad = []
+    for id_, content in conn.execute(sa.select([invoices.c.id, invoices.c.content])).fetchall():
+        try:
+            rows = parse_content(content or "")
+        except InvalidOperation:
+            bad.append(str(id_))
+            continue
+        lines.extend(dict(invoice_id = id_, position = idx, cells = json.dumps(row[:-1]), amount = row[-1])
+                     for idx, row in enumerate(rows))
+    if bad:
+        # Leaving them out would zero their totals
+        raise ValueError("Invoices {} have a row whose last column isn't an amount. "
+                         "Fix them with 'invoice edit' of the version the database was made with "
+                         "and update again.".format(", ".join(bad)))
+
+    invoice_lines = op.create_table('invoice_lines',
+                                    sa.Column('invoice_id', sa.Integer(), nullable=False),
+                                    sa.Column('position', sa.Integer(), nullable=False),
+                                    sa.Column('cells', sa.String(), nullable=False),
+                                    sa.Column('amount', Money(), nullable=False),
+                                    sa.ForeignKeyConstraint(['invoice_id'], ['invoices.id'], ),
+                                    sa.PrimaryKeyConstraint('invoice_id', 'position'))
+    op.create_index('ix_invoice_lines_amount', 'invoice_lines', ['amount'])
+
+    if lines:
+        op.bulk_insert(invoice_lines, lines)
+
+
+def downgrade():
+    op.drop_index('ix_invoice_lines_amount', 'invoice_lines')
+    op.drop_table('invoice_lines')
@@ -0,0 +1,102 @@
+"""head
+
+Revision ID: 0.8.0-alpha
+Revises: 0.7.0-alpha
+Create Date: 2026-10-18 14:21:09.731550
+
+"""
+from collections import OrderedDict, defaultdict
+from decimal import Decimal
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0.8.0-alpha'
+down_revision = '0.7.0-alpha'
+branch_labels = None
+depends_on = None
+
+# Copies of invoice.model.Money, compile_template() and compute_totals()
+# as of this revision, so that later changes to them don't change what
+# this migration does.
+
+class Money(sa.types.TypeDecorator):
+    impl = sa.Integer
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(Decimal(value).quantize(Decimal('0.01')).scaleb(2))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Decimal(value).scaleb(-2)
+
+def compile_template(source):
+    import yaml
+    data = yaml.safe_load(source)
+    fields = [x.strip() for x in data['rows'].strip().strip("|").split("|")]
+    footer_rows = data['footer'].strip().split("\n")
+    footers = [[t.strip() for t in x.strip("|").split("|")] for x in  footer_rows]
+    taxes = OrderedDict((k, str(Decimal(v))) for k,v in (data.get('taxes') or {}).items())
+    return json.dumps(OrderedDict([("fields", fields),
+                                   ("footers", footers),
+                                   ("taxes", taxes)]))
+
+def compute_totals(amounts, taxes):
+    net_total = sum(amounts, Decimal(0))
+    ret = OrderedDict(net_total = net_total)
+    for name, rate in taxes.items():
+        ret[name] = (net_total*Decimal(rate)).quantize(Decimal('0.01'))
+    ret['gross_total'] = sum(ret.values())
+    return ret
+
+templates = sa.table('templates',
+                     sa.column('name', sa.String),
+                     sa.column('template', sa.String),
+                     sa.column('compiled', sa.String))
+
+invoices = sa.table('invoices',
+                    sa.column('id', sa.Integer),
+                    sa.column('template_id', sa.String))
+
+invoice_lines = sa.table('invoice_lines',
+                         sa.column('invoice_id', sa.Integer),
+                         sa.column('amount', Money))
+
+def upgrade():
+    invoice_totals = op.create_table('invoice_totals',
+                                     sa.Column('invoice_id', sa.Integer(), nullable=False),
+                                     sa.Column('name', sa.String(length=50), nullable=False),
+                                     sa.Column('position', sa.Integer(), nullable=False),
+                                     sa.Column('amount', Money(), nullable=False),
+                                     sa.ForeignKeyConstraint(['invoice_id'], ['invoices.id'], ),
+                                     sa.PrimaryKeyConstraint('invoice_id', 'name'))
+    op.create_index('ix_invoice_totals_name_amount', 'invoice_totals', ['name', 'amount'])
+
+    conn = op.get_bind()
+    taxes = {}
+    for name, source, compiled in conn.execute(sa.select([templates])).fetchall():
+        taxes[name] = json.loads(compiled or compile_template(source))['taxes']
+
+    amounts = defaultdict(list)
+    for invoice_id, amount in conn.execute(sa.select([invoice_lines.c.invoice_id, invoice_lines.c.amount])).fetchall():
+        amounts[invoice_id].append(amount)
+
+    totals = []
+    for invoice_id, template in conn.execute(sa.select([invoices.c.id, invoices.c.template_id])).fetchall():
+        if template not in taxes:
+            continue
+        for idx, (name, amount) in enumerate(compute_totals(amounts[invoice_id], taxes[template]).items()):
+            totals.append(dict(invoice_id = invoice_id, name = name, position = idx, amount = amount))
+    if totals:
+        op.bulk_insert(invoice_totals, totals)
+
+
+def downgrade():
+    op.drop_index('ix_invoice_totals_name_amount', 'invoice_totals')
+    op.drop_table('invoice_totals')
@@ -0,0 +1,105 @@
+"""head
+
+Revision ID: 0.9.0-alpha
+Revises: 0.8.0-alpha
+Create Date: 2026-10-18 15:34:52.260178
+
+"""
+from collections import defaultdict
+import datetime
+from decimal import Decimal, InvalidOperation
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0.9.0-alpha'
+down_revision = '0.8.0-alpha'
+branch_labels = None
+depends_on = None
+
+# Copies of invoice.model.Hours and TIMESHEET_DAY_FORMAT as of this
+# revision, so that later changes to them don't change what this
+# migration does.
+
+TIMESHEET_DAY_FORMAT = '%d/%m/%Y %a'
+
+class Hours(sa.types.TypeDecorator):
+    impl = sa.Integer
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(Decimal(value).quantize(Decimal('0.0001')).scaleb(4))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Decimal(value).scaleb(-4)
+
+timesheets = sa.table('timesheets',
+                      sa.column('id', sa.Integer),
+                      sa.column('data', sa.String))
+
+def upgrade():
+    # The data is parsed before the schema is touched, since the data
+    # column is dropped at the end. SQLite can't roll back a half done
+    # migration, so one that stops here can simply be run again.
+    conn = op.get_bind()
+    entries = []
+    bad = []
+    for id_, data in conn.execute(sa.select([timesheets.c.id, timesheets.c.data])).fetchall():
+        try:
+            days = json.loads(data or "{}")
+        except ValueError:
+            bad.append("{} (not JSON)".format(id_))
+            continue
+        for day, hours in days.items():
+            try:
+                date = datetime.datetime.strptime(day, TIMESHEET_DAY_FORMAT).date()
+                hours = Decimal(str(hours))
+            except (ValueError, InvalidOperation):
+                bad.append("{} ({})".format(id_, day))
+                continue
+            entries.append(dict(timesheet_id = id_, date = date, hours = hours))
+    if bad:
+        # Leaving them out would lose those hours with the data column
+        raise ValueError("Timesheets {} have entries that aren't a day and a number of hours. "
+                         "Fix them with the version the database was made with "
+                         "and update again.".format(", ".join(bad)))
+
+    timesheet_entries = op.create_table('timesheet_entries',
+                                        sa.Column('timesheet_id', sa.Integer(), nullable=False),
+                                        sa.Column('date', sa.Date(), nullable=False),
+                                        sa.Column('hours', Hours(), nullable=False),
+                                        sa.ForeignKeyConstraint(['timesheet_id'], ['timesheets.id'], ),
+                                        sa.PrimaryKeyConstraint('timesheet_id', 'date'))
+    op.create_index('ix_timesheet_entries_date', 'timesheet_entries', ['date'])
+    if entries:
+        op.bulk_insert(timesheet_entries, entries)
+
+    with op.batch_alter_table('timesheets') as batch_op:
+        batch_op.drop_column('data')
+
+
+def downgrade():
+    with op.batch_alter_table('timesheets') as batch_op:
+        batch_op.add_column(sa.Column('data', sa.String(length=1000)))
+
+    timesheet_entries = sa.table('timesheet_entries',
+                                 sa.column('timesheet_id', sa.Integer),
+                                 sa.column('date', sa.Date),
+                                 sa.column('hours', Hours))
+    conn = op.get_bind()
+    data = defaultdict(dict)
+    for id_, date, hours in conn.execute(sa.select([timesheet_entries])).fetchall():
+        data[id_][date.strftime(TIMESHEET_DAY_FORMAT)] = str(hours)
+    for id_, entries in data.items():
+        conn.execute(timesheets.update()
+                     .where(timesheets.c.id == id_)
+                     .values(data = json.dumps(entries)))
+
+    op.drop_index('ix_timesheet_entries_date', 'timesheet_entries')
+    op.drop_table('timesheet_entries')
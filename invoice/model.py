@@ -1,19 +1,54 @@
+from collections import OrderedDict
 import datetime
 from decimal import Decimal
+import hashlib
+import itertools
 import json
+import os
+import re
+import sqlite3
+import time
+import urllib.request
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, String, Integer, create_engine, ForeignKey, BLOB, Date, Boolean, Table
-from sqlalchemy.orm import sessionmaker, relationship
-
-import yaml
+from sqlalchemy import Column, String, Integer, create_engine, event, ForeignKey, BLOB, Date, Boolean, Table, Index, func
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker, relationship, object_session, deferred
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.sql import select
 
 from .helpers import memoise, wrap, get_alembic_config
-from alembic import command
 from .import __version__
 
 Base = declarative_base()
 
+class Money(TypeDecorator):
+    """
+    An exact amount stored as an integer number of hundredths so that
+    SQLite can sum and compare amounts without going through floats.
+    """
+    impl = Integer
+    places = 2
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(Decimal(value).quantize(Decimal(1).scaleb(-self.places)).scaleb(self.places))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Decimal(value).scaleb(-self.places)
+
+class Hours(Money):
+    """
+    Like Money but in ten thousandths so that hours clocked to the
+    minute still add up to the right total.
+    """
+    places = 4
+
+
 class InvoiceBase:
     def __repr__(self):
         name = self.name if hasattr(self, "name") else self.id
@@ -66,34 +101,129 @@ class Client(InvoiceBase, Base):
     billing_dom = Column(Integer) # Day of month on which this client should be billed
 
 
+def compile_template(source):
+    """
+    Parses the YAML source of an invoice template into the JSON form
+    stored in InvoiceTemplate.compiled. Raises yaml.YAMLError if it
+    isn't YAML and ValueError if it isn't a template.
+    """
+    import yaml
+    data = yaml.safe_load(source)
+    if not isinstance(data, dict):
+        raise ValueError("The template should be a mapping with 'rows' and 'footer'")
+    for key in ('rows', 'footer'):
+        if not isinstance(data.get(key), str):
+            raise ValueError("'{}' should be a table of | separated cells".format(key))
+    if not isinstance(data.get('taxes') or {}, dict):
+        raise ValueError("'taxes' should map names to rates")
+    for name, rate in (data.get('taxes') or {}).items():
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)):
+            raise ValueError("The rate of tax '{}' should be a number".format(name))
+    fields = [x.strip() for x in data['rows'].strip().strip("|").split("|")]
+    footer_rows = data['footer'].strip().split("\n")
+    footers = [[t.strip() for t in x.strip("|").split("|")] for x in  footer_rows]
+    # Decimal(v) keeps the exact value of the float YAML gave us so
+    # that amounts computed from existing templates don't change.
+    taxes = OrderedDict((k, str(Decimal(v))) for k,v in (data.get('taxes') or {}).items())
+    return json.dumps(OrderedDict([("fields", fields),
+                                   ("footers", footers),
+                                   ("taxes", taxes)]))
+
+# Loaded form of InvoiceTemplate.compiled, by template name. Each entry
+# keeps the string it was loaded from so that it is reloaded when the
+# template changes.
+_compiled_templates = {}
+
+class Letterhead(InvoiceBase, Base):
+    """
+    A letterhead PDF. Templates that use the same letterhead share one
+    row, keyed on the sha256 of the PDF.
+    """
+    __tablename__ = "letterheads"
+    digest = Column(String(64), primary_key = True)
+    # Letterheads run to megabytes and are only needed to render PDFs,
+    # so they're loaded when first accessed rather than with the row.
+    data = deferred(Column(BLOB(1024*1024), nullable = False))
+
+    def __repr__(self):
+        return "<{}(digest='{}'...)>".format(self.__class__.__name__, self.digest)
+
+    @classmethod
+    def get(cls, sess, data):
+        """
+        Returns the letterhead with contents `data`, creating it if it
+        isn't in the database yet.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        letterhead = sess.query(cls).get(digest)
+        if letterhead is None:
+            letterhead = cls(digest = digest, data = data)
+            sess.add(letterhead)
+        return letterhead
+
+    @classmethod
+    def prune(cls, sess):
+        """
+        Deletes letterheads that no template uses anymore.
+        """
+        return sess.query(cls).filter(~cls.templates.any()).delete(synchronize_session = False)
+
 class InvoiceTemplate(InvoiceBase,  Base):
     __tablename__ = "templates"
     name = Column(String(50), primary_key = True)
     description = Column(String(200))
     template = Column(String(500))
+    compiled = Column(String)
     invoices = relationship("Invoice", back_populates="template")
     timesheets = relationship("Timesheet", back_populates="template")
-    letterhead = Column(BLOB(1024*1024))
+    letterhead_digest = Column(String(64), ForeignKey('letterheads.digest', name = 'fk_templates_letterhead_digest'))
+    letterhead_file = relationship('Letterhead', backref = "templates")
+
+    def set_template(self, source):
+        self.compiled = compile_template(source)
+        self.template = source
+        _compiled_templates.pop(self.name, None)
+
+    def set_letterhead(self, sess, data):
+        """
+        Makes `data` (the bytes of a PDF) the letterhead of this
+        template, sharing it with other templates that have the same
+        one. An empty `data` removes the letterhead.
+        """
+        self.letterhead_file = Letterhead.get(sess, data) if data else None
+
+    @property
+    def letterhead(self):
+        return self.letterhead_file.data if self.letterhead_file else None
+
+    @property
+    def spec(self):
+        compiled = self.compiled or compile_template(self.template)
+        cached = _compiled_templates.get(self.name)
+        if cached is None or cached[0] != compiled:
+            data = json.loads(compiled, object_pairs_hook = OrderedDict)
+            data['taxes'] = OrderedDict((k, Decimal(v)) for k,v in data['taxes'].items())
+            cached = _compiled_templates[self.name] = (compiled, data)
+        return cached[1]
 
     @property
     def taxes(self):
-        data = yaml.load(self.template)
-        return data.get('taxes',{})
+        return self.spec['taxes']
 
     @property
     def fields(self):
-        data = yaml.load(self.template)
-        return [x.strip() for x in data['rows'].strip().strip("|").split("|")]
+        return self.spec['fields']
 
     @property
     def footers(self):
-        data = yaml.load(self.template)
-        footer_rows = data['footer'].strip().split("\n")
-        return [[t.strip() for t in x.strip("|").split("|")] for x in  footer_rows]
+        # Copies, so that nothing can change the cached spec
+        return [list(x) for x in self.spec['footers']]
 
 association_table = Table('invoice_tag', Base.metadata,
     Column('invoice_id', Integer, ForeignKey('invoices.id')),
-    Column('tag_name', Integer, ForeignKey('invoicetags.name')))
+    Column('tag_name', Integer, ForeignKey('invoicetags.name')),
+    Index('ix_invoice_tag_invoice_id_tag_name', 'invoice_id', 'tag_name'),
+    Index('ix_invoice_tag_tag_name_invoice_id', 'tag_name', 'invoice_id'))
         
 class InvoiceTag(InvoiceBase, Base):
     __tablename__ = "invoicetags"
@@ -101,8 +231,35 @@ class InvoiceTag(InvoiceBase, Base):
     invoices = relationship('Invoice', secondary=association_table, back_populates="tags")
     system = Column(Boolean(), default = False)
 
+# How days are written in the tables edited by `timesheet add` and `edit`
+TIMESHEET_DAY_FORMAT = '%d/%m/%Y %a'
+
+class TimesheetEntry(InvoiceBase, Base):
+    __tablename__ = "timesheet_entries"
+    __table_args__ = (Index('ix_timesheet_entries_date', 'date'),)
+    timesheet_id = Column(Integer, ForeignKey('timesheets.id'), primary_key = True)
+    date = Column(Date, primary_key = True)
+    hours = Column(Hours, nullable = False)
+
+class TimesheetSource(InvoiceBase, Base):
+    """
+    An org file imported with `timesheet import --incremental` and how
+    much of it has been read (see orgmode.clocked_hours_since()).
+    """
+    __tablename__ = "timesheet_sources"
+    path = Column(String, primary_key = True)
+    timesheet_id = Column(Integer, ForeignKey('timesheets.id'), nullable = False)
+    offset = Column(Integer, nullable = False)
+    checksum = Column(String(64), nullable = False)
+    day = Column(Date)
+    size = Column(Integer, nullable = False)
+    inode = Column(Integer, nullable = False)
+
 class Timesheet(InvoiceBase, Base):
     __tablename__ = "timesheets"
+    __table_args__ = (Index('ix_timesheets_date', 'date'),
+                      Index('ix_timesheets_client_id_date', 'client_id', 'date'),
+                      Index('ix_timesheets_employee_date', 'employee', 'date'))
     id = Column(Integer, primary_key = True)
     template_id = Column(String, ForeignKey('templates.name'))
     template = relationship('InvoiceTemplate')
@@ -110,7 +267,10 @@ class Timesheet(InvoiceBase, Base):
     employee = Column(String(50))
     description = Column(String(100))
     date = Column(Date)
-    data = Column(String(1000))
+    entries = relationship('TimesheetEntry', order_by = TimesheetEntry.date,
+                           cascade = "all, delete-orphan")
+    sources = relationship('TimesheetSource', backref = "timesheet",
+                           cascade = "all, delete-orphan")
     client = relationship('Client')
     
     def summary(self, indent):
@@ -127,47 +287,157 @@ class Timesheet(InvoiceBase, Base):
         return "Timesheet-{}-{}-{}".format(datestr, self.client.name, self.employee)
 
     def serialise(self):
-        data = json.loads(self.data)
-        data = sorted(data.items(), key=lambda x: datetime.datetime.strptime(x[0], '%d/%m/%Y %a'))
-        data = [[datetime.datetime.strptime(day, '%d/%m/%Y %a'), duration] for day,duration in data]
-        
         return dict(client = self.client.name,
-                    data = data,
+                    data = [[x.date, x.hours] for x in self.entries],
                     date = self.date.strftime("%d/%b/%Y"),
                     desc = self.description,
                     emp = self.employee)
 
     def to_table(self):
-        data = json.loads(self.data)
-        data = sorted(data.items(), key=lambda x: datetime.datetime.strptime(x[0], '%d/%m/%Y %a'))
-        org_table = ["| {} | {} |".format(k,Decimal(v).quantize(Decimal('0.01'))) for k,v in data]
+        org_table = ["| {} | {} |".format(x.date.strftime(TIMESHEET_DAY_FORMAT), x.hours.quantize(Decimal('0.01')))
+                     for x in self.entries]
         return "\n".join(org_table)
         
     def set_from_table(self, data):
         data = data.strip()
         ret = {}
         for i in (j.strip() for j in data.split("\n")):
-            if i.startswith("#"):
+            if i.startswith("#") or not i.strip("| "):
                 continue
             k,v = [x.strip() for x in i.strip("|").strip().split("|")]
-            ret[k] = v
-        self.data = json.dumps(ret)
+            ret[datetime.datetime.strptime(k, TIMESHEET_DAY_FORMAT).date()] = Decimal(v)
+        self.set_entries(ret)
+
+    def set_entries(self, hours):
+        """
+        Replaces the entries of the timesheet with `hours`, a mapping
+        of date to the hours worked on it.
+        """
+        existing = {x.date: x for x in self.entries}
+        entries = []
+        for date in sorted(hours):
+            entry = existing.get(date) or TimesheetEntry(date = date)
+            entry.hours = hours[date]
+            entries.append(entry)
+        self.entries = entries
+
+    def add_entries(self, hours):
+        """
+        Adds `hours`, a mapping of date to hours worked, to the entries
+        of the timesheet. Only the entries for those dates are loaded so
+        that adding a day to a long timesheet stays cheap.
+        """
+        sess = object_session(self)
+        if sess is None or self.id is None:
+            total = {x.date: x.hours for x in self.entries}
+            for date, value in hours.items():
+                total[date] = total.get(date, 0) + value
+            self.set_entries(total)
+            return
+        dates = list(hours)
+        existing = {}
+        for i in range(0, len(dates), 500):
+            existing.update((x.date, x) for x in sess.query(TimesheetEntry)
+                            .filter(TimesheetEntry.timesheet_id == self.id,
+                                    TimesheetEntry.date.in_(dates[i:i+500])))
+        for date, value in hours.items():
+            if date in existing:
+                existing[date].hours += value
+            else:
+                sess.add(TimesheetEntry(timesheet_id = self.id, date = date, hours = value))
 
             
                 
 
+def financial_year(date):
+    """
+    Returns the year in which the financial year containing `date`
+    starts. January to April are billed against the previous year.
+    """
+    if 1 <= date.month <= 4:
+        return date.year - 1
+    return date.year
+
+
+def parse_content(content):
+    """
+    Splits the pipe table in Invoice.content into a list of rows. The
+    last cell of each row is the amount and is returned as a Decimal.
+    Empty rows (like the one left in by `invoice add`) are skipped.
+    Raises decimal.InvalidOperation if an amount isn't a number.
+    """
+    ret = []
+    for i in content.split("\n"):
+        i = i.strip()
+        if i.startswith("#") or not i:
+            continue
+        fields = i.strip().strip("|").split("|")
+        if not any(x.strip() for x in fields):
+            continue
+        fields[-1] = Decimal(fields[-1]).quantize(Decimal('0.01'))
+        ret.append(fields)
+    return ret
+
+class InvoiceLine(InvoiceBase, Base):
+    """
+    One row of an invoice's content. `cells` is a JSON list of all but
+    the last column, which is stored in `amount`.
+    """
+    __tablename__ = "invoice_lines"
+    __table_args__ = (Index('ix_invoice_lines_amount', 'amount'),)
+    invoice_id = Column(Integer, ForeignKey('invoices.id'), primary_key = True)
+    position = Column(Integer, primary_key = True)
+    cells = Column(String, nullable = False)
+    amount = Column(Money, nullable = False)
+
+    @property
+    def columns(self):
+        return json.loads(self.cells) + [self.amount]
+
+def compute_totals(amounts, taxes):
+    """
+    Returns the net total of `amounts`, each of the `taxes` (a mapping
+    of name to rate) on it and the gross total, in that order. These
+    are the values the footers of an invoice template refer to.
+    """
+    net_total = sum(amounts, Decimal(0))
+    ret = OrderedDict(net_total = net_total)
+    for name, rate in taxes.items():
+        ret[name] = (net_total*Decimal(rate)).quantize(Decimal('0.01'))
+    ret['gross_total'] = sum(ret.values())
+    return ret
+
+class InvoiceTotal(InvoiceBase, Base):
+    """
+    One of the totals of an invoice (see compute_totals()), kept up to
+    date by Invoice.update_totals() so that nothing has to render or
+    parse an invoice to find out how much it was for.
+    """
+    __tablename__ = "invoice_totals"
+    __table_args__ = (Index('ix_invoice_totals_name_amount', 'name', 'amount'),)
+    invoice_id = Column(Integer, ForeignKey('invoices.id'), primary_key = True)
+    name = Column(String(50), primary_key = True)
+    position = Column(Integer, nullable = False)
+    amount = Column(Money, nullable = False)
 
 class Invoice(InvoiceBase, Base):
     __tablename__ = "invoices"
+    __table_args__ = (Index('ix_invoices_date', 'date'),
+                      Index('ix_invoices_client_id_date', 'client_id', 'date'))
     id = Column(Integer,  primary_key = True)
-    disp_number = Column(Integer, unique=True)
+    disp_number = Column(Integer)
     date = Column(Date)
     template_id = Column(String, ForeignKey('templates.name'))
     template = relationship('InvoiceTemplate')
     particulars = Column(String)
     client = relationship('Client')
     client_id = Column(String,  ForeignKey('clients.name'))
-    content = Column(String)
+    # Only needed to edit the invoice. Everything else uses the lines.
+    content = deferred(Column(String))
+    lines = relationship('InvoiceLine', order_by = InvoiceLine.position,
+                         cascade = "all, delete-orphan")
+    totals = relationship('InvoiceTotal', order_by = InvoiceTotal.position,
+                          cascade = "all, delete-orphan")
     tags = relationship('InvoiceTag', secondary=association_table, back_populates="invoices")
     
     def summary(self, indent):
@@ -186,30 +456,45 @@ class Invoice(InvoiceBase, Base):
 
     @property
     def number(self):
-        curr_year = int(self.date.strftime("%Y"))
-        curr_month = int(self.date.strftime("%m"))
+        curr_year = financial_year(self.date)
+        next_year = curr_year + 1
         prefix = self.client.account.prefix
-        if 1 <= curr_month <= 4: 
-            next_year = curr_year
-            curr_year -= 1
-        else:
-            next_year = curr_year + 1
         if prefix:
             return "{}/{}-{}-{}".format(curr_year, next_year, prefix, self.disp_number)
         else:
             return "{}/{}-{}".format(curr_year, next_year, self.disp_number)
     
+    def set_content(self, content):
+        """
+        Sets the content of the invoice and replaces its lines with the
+        rows parsed from it. The totals are updated if the invoice
+        already has a template.
+        """
+        rows = parse_content(content)
+        self.content = content
+        self.lines = [InvoiceLine(position = idx, cells = json.dumps(row[:-1]), amount = row[-1])
+                      for idx, row in enumerate(rows)]
+        if self.template:
+            self.update_totals()
+
+    def update_totals(self):
+        """
+        Recomputes the stored totals from the lines and the taxes of the
+        template. Needs to be called when either of them changes.
+        """
+        totals = compute_totals((x.amount for x in self.lines), self.template.taxes)
+        existing = {x.name: x for x in self.totals}
+        new = []
+        for idx, (name, amount) in enumerate(totals.items()):
+            total = existing.get(name) or InvoiceTotal(name = name)
+            total.position = idx
+            total.amount = amount
+            new.append(total)
+        self.totals = new
+
     @property
     def columns(self):
-        ret = []
-        for i in self.content.split("\n"):
-            i = i.strip()
-            if i.startswith("#") or not i:
-                continue
-            fields = i.strip().strip("|").split("|")
-            fields[-1] = Decimal(fields[-1]).quantize(Decimal('0.01'))
-            ret.append(fields)
-        return ret
+        return [line.columns for line in self.lines]
 
         
     def serialise(self):
@@ -230,23 +515,148 @@ class Invoice(InvoiceBase, Base):
                     fields = self.template.fields,
                     columns = self.columns,
                     footers = self.template.footers,
-                    taxes = self.template.taxes,
+                    totals = OrderedDict((x.name, x.amount) for x in self.totals),
                     bank_details = self.client.account.bank_details)
     
 
+class InvoiceCounter(InvoiceBase, Base):
+    """
+    Last invoice number handed out for an account. `year` is the
+    financial year the numbers belong to or 0 if the account's
+    numbering doesn't restart every year.
+    """
+    __tablename__ = "invoice_counters"
+    account_id = Column(Integer, ForeignKey('accounts.id'), primary_key = True)
+    year = Column(Integer, primary_key = True, default = 0)
+    last_number = Column(Integer, nullable = False)
+
+
+# SQLite settings applied to every connection. Each of these can be
+# changed with a row of the same name in the config table or with the
+# matching INVOICE_ environment variable (e.g. INVOICE_BUSY_TIMEOUT),
+# which takes precedence.
+PRAGMA_DEFAULTS = OrderedDict([("journal_mode", "wal"),
+                               ("synchronous", "normal"),
+                               ("busy_timeout", "5000"),
+                               ("mmap_size", "268435456"),
+                               ("cache_size", "-16000"),
+                               ("temp_store", "memory")])
+
+def get_pragmas(dbapi_connection):
+    pragmas = OrderedDict(PRAGMA_DEFAULTS)
+    try:
+        names = ", ".join("'{}'".format(x) for x in pragmas)
+        pragmas.update(dbapi_connection.execute("SELECT name, value FROM config WHERE name IN ({})".format(names)))
+    except sqlite3.OperationalError:
+        pass # Database not initialised yet
+    for name in pragmas:
+        envvar = "INVOICE_{}".format(name.upper())
+        if envvar in os.environ:
+            pragmas[name] = os.environ[envvar]
+    for name, value in pragmas.items():
+        if not re.match(r"^-?\w+$", str(value)):
+            raise ValueError("Bad value '{}' for SQLite setting {}".format(value, name))
+    return pragmas
+
+def sql_financial_year(date):
+    if date is None:
+        return None
+    return financial_year(datetime.date(*(int(x) for x in date[:10].split("-"))))
+
+# Python functions made available to SQL so that reports can be
+# aggregated by SQLite.
+SQL_FUNCTIONS = [("financial_year", 1, sql_financial_year)]
+
+def configure_connection(dbapi_connection, connection_record, readonly = False):
+    for name, nargs, function in SQL_FUNCTIONS:
+        dbapi_connection.create_function(name, nargs, function, deterministic = True)
+    cursor = dbapi_connection.cursor()
+    for name, value in get_pragmas(dbapi_connection).items():
+        if readonly and name == "journal_mode":
+            continue # Can't be changed without writing to the database
+        cursor.execute("PRAGMA {} = {}".format(name, value))
+    if readonly:
+        cursor.execute("PRAGMA query_only = 1")
+    cursor.close()
+
+def get_session(db_file, readonly = False):
+    """
+    Returns the session for `db_file`. A readonly session opens the
+    database in read only mode so that listing commands never take a
+    lock that would hold up writers.
+    """
+    return _get_session(db_file, bool(readonly))
 
 @memoise
-def get_session(db_file):
-    url = "sqlite:///{}".format(db_file)
-    engine = create_engine(url)
+def _get_session(db_file, readonly):
+    if readonly:
+        url = "file:{}?mode=ro".format(urllib.request.pathname2url(os.path.abspath(db_file)))
+        engine = create_engine("sqlite://", creator = lambda: sqlite3.connect(url, uri = True))
+    else:
+        url = "sqlite:///{}".format(db_file)
+        engine = create_engine(url)
+    event.listen(engine, "connect", lambda conn, record: configure_connection(conn, record, readonly))
     Session = sessionmaker(bind = engine)
     session = Session()
     return session
 
+def get_db_version(sess):
+    """
+    Returns the version recorded in the database. This runs before every
+    command so it is a plain SELECT which doesn't need the ORM set up.
+    """
+    config = Config.__table__
+    version = sess.execute(select([config.c.value]).where(config.c.name == "version")).scalar()
+    if version is None:
+        raise NoResultFound("No version in database")
+    return version
+
+def allocate_invoice_numbers(sess, account, year = 0, count = 1, retries = 10):
+    """
+    Reserves `count` consecutive invoice numbers for `account` (and
+    financial `year` if numbering restarts every year) and returns the
+    first of them.
+
+    This takes the database write lock with BEGIN IMMEDIATE so it has
+    to be called before anything else is written in the session's
+    current transaction. The transaction is left open so that the
+    caller can add the invoices and commit them along with the
+    counter. If another process holds the lock, it is retried with a
+    growing delay.
+    """
+    for attempt in itertools.count():
+        try:
+            sess.execute("BEGIN IMMEDIATE")
+            break
+        except OperationalError as e:
+            sess.rollback()
+            if attempt >= retries or "locked" not in str(e):
+                raise
+            time.sleep(0.05 * 2**min(attempt, 5))
+
+    counter = sess.query(InvoiceCounter).get((account.id, year))
+    if counter is None:
+        # First number for this account (and year). Carry on from the
+        # invoices it already has.
+        last_number = sess.query(func.max(Invoice.disp_number)).join(Client).filter(Client.account_id == account.id)
+        if year:
+            # See financial_year()
+            last_number = last_number.filter(datetime.date(year, 5, 1) <= Invoice.date,
+                                             Invoice.date < datetime.date(year+1, 5, 1))
+        counter = InvoiceCounter(account_id = account.id,
+                                 year = year,
+                                 last_number = last_number.scalar() or 0)
+        sess.add(counter)
+    first = counter.last_number + 1
+    counter.last_number += count
+    sess.flush()
+    return first
+
 def create_database(db_file):
     url = "sqlite:///{}".format(db_file)
     engine = create_engine(url)
     Base.metadata.create_all(engine)
+    from alembic import command
     alembic_cfg = get_alembic_config(db_file)
     command.stamp(alembic_cfg, __version__)
     
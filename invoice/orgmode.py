@@ -0,0 +1,162 @@
+"""
+Reads the time clocked in org mode files for `timesheet import` and
+`timesheet parse`.
+
+The files are multi-year logs that can run to millions of lines, so
+rather than looking at every line in Python, the file is mapped into
+memory and regular expressions pick out just the day headings and the
+CLOCK lines.
+"""
+
+from collections import defaultdict, namedtuple
+import datetime
+from decimal import Decimal
+import hashlib
+import mmap
+import multiprocessing
+import os
+import re
+
+# Both patterns start with literal text, which lets the regular
+# expression engine skip ahead to candidates instead of trying to match
+# at every position.
+HEADING_RE = re.compile(rb"\*\*+ [\[<](\d+)-(\d+)-(\d+) [^\s\]>]+")
+CLOCK_RE = re.compile(rb"CLOCK: \[(\d+)-(\d+)-(\d+) [^\s\]]+ (\d+):(\d+)\]--"
+                      rb"\[(\d+)-(\d+)-(\d+) [^\s\]]+ (\d+):(\d+)\] +=> +\d+:\d+")
+# A clock that is still running. Org mode rewrites the line when it's
+# stopped.
+OPEN_CLOCK_RE = re.compile(rb"CLOCK: \[[^\]\n]*\][ \t]*$", re.M)
+
+# How far an incremental read got into a file: the number of bytes
+# read, the sha256 of the last TAIL of those bytes, the day heading in
+# effect there, and the size and inode of the file at the time.
+Watermark = namedtuple("Watermark", "offset checksum day size inode")
+
+# Bytes before the watermark that are checked for changes
+TAIL = 64 * 1024
+
+# Inodes are kept to this range to fit in an SQLite integer
+INODE_RANGE = 2 ** 63
+
+def scan(data, start, end, day = None):
+    """
+    Adds up the minutes clocked between `start` and `end` in `data`
+    (the contents of an org file) by day. `day` is the day heading in
+    effect at `start`. Returns the minutes and the day heading in
+    effect at `end`.
+    """
+    minutes = defaultdict(int)
+    ordinals = {}
+    # Day headings by position in the file
+    headings = [(m.start(), datetime.date(*(int(x) for x in m.groups())))
+                for m in HEADING_RE.finditer(data, start, end)
+                if m.start() == 0 or data[m.start() - 1] == ord("\n")]
+    headings.append((end, None))
+    heading = 0
+    for match in CLOCK_RE.finditer(data, start, end):
+        while headings[heading][0] < match.start():
+            day = headings[heading][1]
+            heading += 1
+        y0, m0, d0, hh0, mm0, y1, m1, d1, hh1, mm1 = match.groups()
+        duration = (int(hh1) - int(hh0)) * 60 + int(mm1) - int(mm0)
+        if (y0, m0, d0) != (y1, m1, d1):
+            # Clocked past midnight
+            for key in ((y0, m0, d0), (y1, m1, d1)):
+                if key not in ordinals:
+                    ordinals[key] = datetime.date(*(int(x) for x in key)).toordinal()
+            duration += (ordinals[(y1, m1, d1)] - ordinals[(y0, m0, d0)]) * 24 * 60
+        minutes[day or datetime.date(int(y0), int(m0), int(d0))] += duration
+    for _, heading_day in headings[heading:-1]:
+        day = heading_day
+    return minutes, day
+
+def to_hours(minutes):
+    return {k: Decimal(v) / 60 for k, v in minutes.items()}
+
+def clocked_hours(fname):
+    """
+    Returns the hours clocked in the org file `fname` as a dictionary
+    of date to Decimal hours. Time is counted against the day of the
+    heading (like "** <2017-05-03 Wed>") it is clocked under or,
+    before the first day heading, the day the clock started.
+    """
+    with open(fname, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return {}
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+            minutes, _ = scan(data, 0, len(data))
+    return to_hours(minutes)
+
+def tail_checksum(data, offset):
+    """
+    The sha256 of the TAIL bytes of `data` before `offset`.
+    """
+    return hashlib.sha256(memoryview(data)[max(0, offset - TAIL):offset]).hexdigest()
+
+def clocked_hours_since(fname, watermark = None):
+    """
+    Like clocked_hours() but only reads what has been added to `fname`
+    since the read that returned `watermark`. The file is read from the
+    beginning instead if it has been replaced (its inode differs), has
+    shrunk, or the TAIL bytes before the watermark have changed. Checking
+    only those keeps the cost of a read to the new lines; edits further
+    back in the file aren't noticed.
+
+    Reading stops at the end of the last complete line or at the first
+    clock that is still running, whichever comes first, so that lines
+    which may still change are read next time.
+
+    Returns the hours, the new watermark and whether the whole file was
+    read (in which case the hours replace rather than add to the ones
+    read before).
+    """
+    with open(fname, "rb") as f:
+        stat = os.fstat(f.fileno())
+        inode = stat.st_ino % INODE_RANGE
+        if stat.st_size == 0:
+            return {}, Watermark(0, tail_checksum(b"", 0), None, 0, inode), True
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+            start, day = 0, None
+            if (watermark and watermark.inode == inode and watermark.size <= len(data)
+                    and tail_checksum(data, watermark.offset) == watermark.checksum):
+                start, day = watermark.offset, watermark.day
+
+            end = data.rfind(b"\n", start) + 1 or start
+            running = OPEN_CLOCK_RE.search(data, start, end)
+            if running:
+                end = data.rfind(b"\n", start, running.start()) + 1 or start
+
+            minutes, day = scan(data, start, end, day)
+            new = Watermark(end, tail_checksum(data, end), day, len(data), inode)
+    return to_hours(minutes), new, start == 0
+
+def find_org_files(paths):
+    """
+    Expands `paths` into a list of files, replacing each directory with
+    the .org files under it in name order.
+    """
+    ret = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                ret.extend(os.path.join(dirpath, x) for x in sorted(filenames) if x.endswith(".org"))
+        else:
+            ret.append(path)
+    return ret
+
+def clocked_hours_batch(fnames, jobs = 1, watermarks = None):
+    """
+    Returns clocked_hours() for each of `fnames`, in order. If
+    `watermarks` is given (a watermark or None for each file),
+    clocked_hours_since() is used instead. If `jobs` is more than 1,
+    the files are parsed by a pool of that many processes.
+    """
+    if watermarks is None:
+        fn, args = clocked_hours, [(x,) for x in fnames]
+    else:
+        fn, args = clocked_hours_since, list(zip(fnames, watermarks))
+    if jobs <= 1 or len(fnames) <= 1:
+        return [fn(*x) for x in args]
+    with multiprocessing.Pool(min(jobs, len(fnames))) as pool:
+        return pool.starmap(fn, args, chunksize = 1)
@@ -0,0 +1,307 @@
+"""
+Timing of the phases a command spends its time in, for --profile.
+
+Code marks out a phase with `with profiling.phase("layout"):`. While
+profiling is on, the wall and CPU time of each phase are added up for
+the document being worked on (set with profiling.document()). Phases
+nest and their times are exclusive, so the time of a phase doesn't
+include that of the phases inside it. SQL statements are a phase of
+their own, timed through SQLAlchemy's engine events, so for example
+the lazy loads done by serialise() are counted as SQL rather than as
+serialising.
+
+The peak resident memory is reported too. Tracing the memory Python
+allocates with tracemalloc gives a more precise peak but slows down
+layout several times over, so it has to be asked for.
+
+When profiling is off, phase() and document() do nothing.
+"""
+
+from collections import OrderedDict
+import logging
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: # Not on Windows
+    resource = None
+
+# Phases in the order they're reported
+PHASES = ["sql", "serialise", "layout", "merge", "write", "bundle"]
+
+# Documents shown in the summary, slowest first
+SLOWEST = 10
+
+# Label for the time spent outside any document
+OTHER = "(no document)"
+
+_profiler = None
+
+class _Null:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null = _Null()
+
+
+class _Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.enter(self.name)
+
+    def __exit__(self, *exc):
+        self.profiler.exit()
+        return False
+
+
+class _Document:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.previous, self.profiler.document = self.profiler.document, self.name
+
+    def __exit__(self, *exc):
+        self.profiler.document = self.previous
+        return False
+
+
+def peak_rss():
+    """
+    The peak resident memory of this process in bytes, or 0 if it isn't
+    known.
+    """
+    if not resource:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Profiler:
+    """
+    Adds up the calls, wall time and CPU time of each phase for each
+    document. If `memory`, also traces the peak memory allocated by
+    Python. If `dump` is given, runs cProfile and writes its statistics
+    there.
+    """
+    def __init__(self, dump = None, memory = False):
+        self.documents = OrderedDict()
+        self.document = None
+        self.stack = []
+        self.dump = dump
+        self.memory = memory
+        # Peaks of the worker processes: resident and traced
+        self.worker_peaks = [0, 0]
+        self.cprofile = None
+
+    def start(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        event.listen(Engine, "before_cursor_execute", self.before_execute)
+        event.listen(Engine, "after_cursor_execute", self.after_execute)
+        event.listen(Engine, "handle_error", self.execute_failed)
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        if self.memory:
+            tracemalloc.start()
+        if self.dump:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def stop(self):
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.dump)
+        self.wall = time.perf_counter() - self.start_wall
+        self.cpu = time.process_time() - self.start_cpu
+        self.peaks = [peak_rss(), 0]
+        if self.memory:
+            self.peaks[1] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.detach()
+
+    def detach(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        if self.cprofile:
+            self.cprofile.disable()
+        event.remove(Engine, "before_cursor_execute", self.before_execute)
+        event.remove(Engine, "after_cursor_execute", self.after_execute)
+        event.remove(Engine, "handle_error", self.execute_failed)
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.enter("sql")
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.exit()
+
+    def execute_failed(self, context):
+        if self.stack and self.stack[-1][0] == "sql":
+            self.exit()
+
+    def enter(self, name):
+        self.stack.append([name, time.perf_counter(), time.process_time(), 0.0, 0.0])
+
+    def exit(self):
+        name, wall, cpu, inner_wall, inner_cpu = self.stack.pop()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        self.add(name, 1, wall - inner_wall, cpu - inner_cpu)
+        if self.stack:
+            self.stack[-1][3] += wall
+            self.stack[-1][4] += cpu
+
+    def add(self, name, calls, wall, cpu):
+        phases = self.documents.setdefault(self.document, {})
+        totals = phases.setdefault(name, [0, 0.0, 0.0])
+        totals[0] += calls
+        totals[1] += wall
+        totals[2] += cpu
+
+    def collect(self):
+        """
+        Returns the phases recorded so far, outside of any document,
+        and the peak memory, and starts again. Used by the processes
+        that render documents in parallel to send their timings back.
+        """
+        traced = tracemalloc.get_traced_memory()[1] if self.memory else 0
+        ret = dict(phases = self.documents.pop(None, {}), peaks = [peak_rss(), traced])
+        self.documents.clear()
+        return ret
+
+    def merge(self, collected):
+        for name, (calls, wall, cpu) in collected['phases'].items():
+            self.add(name, calls, wall, cpu)
+        self.worker_peaks = [max(x) for x in zip(self.worker_peaks, collected['peaks'])]
+
+    def report(self):
+        """
+        Returns the lines of the summary: the totals of each phase, then
+        the slowest documents.
+        """
+        totals = {}
+        for phases in self.documents.values():
+            for name, (calls, wall, cpu) in phases.items():
+                total = totals.setdefault(name, [0, 0.0, 0.0])
+                total[0] += calls
+                total[1] += wall
+                total[2] += cpu
+        count = len([x for x in self.documents if x is not None])
+        workers = any(self.worker_peaks)
+        names = [x for x in PHASES if x in totals] + sorted(x for x in totals if x not in PHASES)
+
+        ret = ["Profile: {:.2f}s wall, {:.2f}s CPU, {} documents, {} SQL statements".format(
+            self.wall, self.cpu, count, totals.get("sql", [0])[0])]
+        for label, peak, worker_peak in zip(("Peak resident memory", "Peak traced memory"),
+                                            self.peaks, self.worker_peaks):
+            if peak:
+                ret.append("{}: {:.1f} MB{}".format(label, peak / 1e6,
+                                                    ", {:.1f} MB in a worker".format(worker_peak / 1e6)
+                                                    if worker_peak else ""))
+        if workers:
+            ret.append("Phases include the time spent in the worker processes")
+        ret.append("{:12} {:>8} {:>10} {:>10} {:>12}".format("Phase", "Calls", "Wall (s)", "CPU (s)", "Per doc (ms)"))
+        for name in names:
+            calls, wall, cpu = totals[name]
+            ret.append("{:12} {:>8} {:>10.3f} {:>10.3f} {:>12.2f}".format(
+                name, calls, wall, cpu, 1000 * wall / count if count else 0))
+        if not workers:
+            # Phases of worker processes overlap, so this only adds up
+            # when everything ran here.
+            other = self.wall - sum(x[1] for x in totals.values())
+            ret.append("{:12} {:>8} {:>10.3f}".format("other", "", other))
+
+        documents = sorted(((name, phases) for name, phases in self.documents.items() if name is not None),
+                           key = lambda x: -sum(t[1] for t in x[1].values()))
+        if documents:
+            ret.append("Slowest documents (wall ms):")
+            ret.append("  {:50} {:>9}".format("Document", "Total") + "".join(" {:>9}".format(x) for x in names))
+            for name, phases in documents[:SLOWEST]:
+                ret.append("  {:50} {:>9.1f}".format(name[:50], 1000 * sum(t[1] for t in phases.values()))
+                           + "".join(" {:>9.1f}".format(1000 * phases.get(x, [0, 0.0])[1]) for x in names))
+        return ret
+
+    def document_lines(self):
+        """
+        Yields a line for every document with the wall and CPU time of
+        each of its phases.
+        """
+        for name, phases in self.documents.items():
+            yield "{}: {}".format(name or OTHER, ", ".join(
+                "{} {} calls {:.1f}/{:.1f} ms".format(x, calls, 1000 * wall, 1000 * cpu)
+                for x, (calls, wall, cpu) in phases.items()))
+
+
+def start(dump = None, memory = False):
+    """
+    Turns profiling on in this process. If `memory`, the memory Python
+    allocates is traced. If `dump` is given, cProfile statistics are
+    written to it when profiling is stopped.
+    """
+    global _profiler
+    if _profiler:
+        # Inherited from the parent by a forked worker process
+        _profiler.detach()
+    _profiler = Profiler(dump, memory)
+    _profiler.start()
+
+def stop():
+    """
+    Turns profiling off and logs the summary. Each document's phases
+    are logged too at debug level.
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    profiler.stop()
+    l = logging.getLogger("invoice")
+    for line in profiler.document_lines():
+        l.debug("%s", line)
+    for line in profiler.report():
+        l.info("%s", line)
+    if profiler.dump:
+        l.info("cProfile statistics written to %s", profiler.dump)
+
+def options():
+    """
+    The arguments to start() with to profile another process the way
+    this one is, or None if profiling is off.
+    """
+    return dict(memory = _profiler.memory) if _profiler else None
+
+def phase(name):
+    """
+    Context manager for the time spent in the phase `name`.
+    """
+    return _Phase(_profiler, name) if _profiler else _null
+
+def document(name):
+    """
+    Context manager under which phases are counted for the document
+    `name`.
+    """
+    return _Document(_profiler, name) if _profiler else _null
+
+def collect():
+    """
+    The phases recorded since the last call, or None if profiling is
+    off. See Profiler.collect().
+    """
+    return _profiler.collect() if _profiler else None
+
+def merge(collected):
+    """
+    Adds phases returned by collect() in another process to the
+    current document.
+    """
+    if _profiler and collected:
+        _profiler.merge(collected)
@@ -0,0 +1,236 @@
+"""
+The queries used by commands that filter invoices and timesheets. They
+are kept together here so that `db explain` can print the plan SQLite
+uses for each of them.
+"""
+
+from collections import OrderedDict
+import datetime
+from decimal import Decimal
+
+from sqlalchemy import func
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import joinedload, subqueryload
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from . import model
+
+# Label of the report row for invoices and hours without a group
+NO_GROUP = "(none)"
+
+# Everything Invoice.number and Invoice.serialise() need, so that
+# going through a list of invoices doesn't issue queries per row.
+def invoice_details(query):
+    return query.options(joinedload(model.Invoice.client).joinedload(model.Client.account),
+                         subqueryload(model.Invoice.template),
+                         subqueryload(model.Invoice.lines),
+                         subqueryload(model.Invoice.totals))
+
+def timesheet_details(query):
+    return query.options(joinedload(model.Timesheet.client),
+                         subqueryload(model.Timesheet.template),
+                         subqueryload(model.Timesheet.entries))
+
+def invoice_list(sess, from_, to, client = None, tags = None, all_ = False):
+    invoices = invoice_details(sess.query(model.Invoice)).options(subqueryload(model.Invoice.tags))
+    if tags:
+        invoices = invoices.filter(model.Invoice.tags.any(model.InvoiceTag.name.in_(tags)))
+
+    if from_:
+        invoices = invoices.filter(from_ <= model.Invoice.date)
+
+    invoices = invoices.filter(model.Invoice.date <= to)
+
+    if not all_:
+        invoices = invoices.filter(model.Invoice.tags.any(model.InvoiceTag.name != 'cancelled'))
+
+    if client:
+        invoices = invoices.filter(model.Invoice.client_id == client)
+    return invoices
+
+def invoice_range(sess, date_start, date_to, client = None):
+    invoices = invoice_details(sess.query(model.Invoice)).filter(date_start <= model.Invoice.date,
+                                                model.Invoice.date <= date_to)
+    if client:
+        invoices = invoices.filter(model.Invoice.client_id == client)
+    return invoices
+
+def template_invoices(sess, template = None):
+    """
+    Invoices with what Invoice.update_totals() needs, limited to those
+    using `template` (a template name) if given.
+    """
+    invoices = sess.query(model.Invoice).options(subqueryload(model.Invoice.template),
+                                                 subqueryload(model.Invoice.lines),
+                                                 subqueryload(model.Invoice.totals))
+    if template:
+        invoices = invoices.filter(model.Invoice.template_id == template)
+    return invoices
+
+def timesheet_range(sess, date_start, date_to, client = None, employee = None):
+    timesheets = timesheet_details(sess.query(model.Timesheet)).filter(date_start <= model.Timesheet.date,
+                                                    model.Timesheet.date <= date_to)
+    if client:
+        timesheets = timesheets.filter(model.Timesheet.client_id == client)
+    if employee:
+        timesheets = timesheets.filter(model.Timesheet.employee == employee)
+    return timesheets
+
+def timesheet_list(sess, chronological = False):
+    timesheets = timesheet_details(sess.query(model.Timesheet))
+    if chronological:
+        timesheets = timesheets.order_by(model.Timesheet.date)
+    return timesheets
+
+def summary_invoices(sess, chronological = False):
+    invoices = sess.query(model.Invoice).options(subqueryload(model.Invoice.template),
+                                                 subqueryload(model.Invoice.tags))
+    if chronological:
+        return invoices.order_by(model.Invoice.client_id, model.Invoice.date)
+    return invoices.order_by(model.Invoice.client_id, model.Invoice.id)
+
+def summary_timesheets(sess, chronological = False):
+    timesheets = sess.query(model.Timesheet).options(subqueryload(model.Timesheet.template))
+    if chronological:
+        return timesheets.order_by(model.Timesheet.client_id, model.Timesheet.date)
+    return timesheets.order_by(model.Timesheet.client_id, model.Timesheet.id)
+
+# Ways of grouping `invoice report`
+REPORT_GROUPS = ("month", "year", "client", "account", "tag")
+
+def report_group(query, group, date, client_id):
+    """
+    Adds what's needed to `query` to group it by `group` and returns it
+    along with the expression to group by. `date` and `client_id` are
+    the columns the query is dated and billed by.
+    """
+    if group == "month":
+        return query, func.strftime("%Y-%m", date)
+    if group == "year":
+        return query, func.financial_year(date)
+    if group == "client":
+        return query, client_id
+    if group == "account":
+        # Outer joins so that clients without an account are counted too
+        query = query.outerjoin(model.Client, model.Client.name == client_id).outerjoin(model.Account)
+        return query, model.Account.name
+    if group == "tag":
+        query = query.join(model.association_table, model.association_table.c.invoice_id == model.Invoice.id)
+        return query, model.association_table.c.tag_name
+    raise ValueError("Can't group by '{}'".format(group))
+
+def report_totals(sess, group, from_ = None, to = None, client = None, all_ = False):
+    """
+    The sum of each total (see model.compute_totals()) and the number of
+    invoices it came from, for every group.
+    """
+    query = sess.query(model.Invoice).join(model.Invoice.totals)
+    query, key = report_group(query, group, model.Invoice.date, model.Invoice.client_id)
+    query = query.with_entities(key.label("key"),
+                                model.InvoiceTotal.name,
+                                func.min(model.InvoiceTotal.position),
+                                func.sum(model.InvoiceTotal.amount),
+                                func.count(model.InvoiceTotal.invoice_id))
+    if from_:
+        query = query.filter(from_ <= model.Invoice.date)
+    if to:
+        query = query.filter(model.Invoice.date <= to)
+    if client:
+        query = query.filter(model.Invoice.client_id == client)
+    if not all_:
+        query = query.filter(~model.Invoice.tags.any(model.InvoiceTag.name == 'cancelled'))
+    return query.group_by(key, model.InvoiceTotal.name)
+
+def report_hours(sess, group, from_ = None, to = None, client = None):
+    """
+    The hours worked for every group, by the day they were worked on.
+    """
+    query = sess.query(model.TimesheetEntry).join(model.Timesheet)
+    query, key = report_group(query, group, model.TimesheetEntry.date, model.Timesheet.client_id)
+    query = query.with_entities(key.label("key"),
+                                func.sum(model.TimesheetEntry.hours))
+    if from_:
+        query = query.filter(from_ <= model.TimesheetEntry.date)
+    if to:
+        query = query.filter(model.TimesheetEntry.date <= to)
+    if client:
+        query = query.filter(model.Timesheet.client_id == client)
+    return query.group_by(key)
+
+def report(sess, group, from_ = None, to = None, client = None, all_ = False):
+    """
+    Returns the names of the totals (net total, the taxes and gross
+    total) and a list of rows, one per group, each an OrderedDict with
+    the group, the number of invoices, the totals and the hours billed.
+    Hours aren't tracked by tag so they are left out when grouping by
+    tag.
+    """
+    totals = report_totals(sess, group, from_, to, client, all_).all()
+    hours = {}
+    if group != "tag":
+        hours = {k: v.quantize(Decimal('0.01')) for k, v in report_hours(sess, group, from_, to, client)}
+
+    positions = {}
+    for _, name, position, _, _ in totals:
+        positions[name] = min(position, positions.get(name, position))
+    order = {"net_total" : -1, "gross_total" : len(positions)}
+    names = sorted(positions, key = lambda x: (order.get(x, positions[x]), x))
+
+    rows = OrderedDict()
+    # Invoices without a client or clients without an account are
+    # grouped under None, which goes last
+    for key in sorted(set(x[0] for x in totals) | set(hours), key = lambda x: (x is None, x)):
+        label = key
+        if key is None:
+            label = NO_GROUP
+        elif group == "year":
+            label = "{}/{}".format(key, key + 1)
+        rows[key] = OrderedDict([(group, label), ("invoices", 0)])
+        rows[key].update((x, Decimal("0.00")) for x in names)
+        if group != "tag":
+            rows[key]["hours"] = hours.get(key, Decimal("0.00"))
+    for key, name, _, amount, count in totals:
+        rows[key][name] = amount
+        if name == "net_total":
+            rows[key]["invoices"] = count
+    return names, list(rows.values())
+
+
+def builtin_queries(sess):
+    """
+    Returns the queries above, with typical arguments, keyed by the
+    command that runs them.
+    """
+    to = datetime.date.today()
+    from_ = to - datetime.timedelta(days = 30)
+    client = "client"
+    return OrderedDict([
+        ("invoice ls", invoice_list(sess, from_, to)),
+        ("invoice ls -a -c", invoice_list(sess, from_, to, client = client, all_ = True)),
+        ("invoice ls -g", invoice_list(sess, from_, to, tags = ["tag"])),
+        ("invoice generate", invoice_range(sess, from_, to)),
+        ("invoice generate -c", invoice_range(sess, from_, to, client)),
+        ("invoice recompute -t", template_invoices(sess, "template")),
+        ("invoice report", report_totals(sess, "month", from_, to)),
+        ("invoice report (hours)", report_hours(sess, "month", from_, to)),
+        ("timesheet generate", timesheet_range(sess, from_, to)),
+        ("timesheet generate -c", timesheet_range(sess, from_, to, client = client)),
+        ("timesheet generate -e", timesheet_range(sess, from_, to, employee = "employee")),
+        ("timesheet ls -c", timesheet_list(sess, True)),
+        ("summary -c (invoices)", summary_invoices(sess, True)),
+        ("summary -c (timesheets)", summary_timesheets(sess, True))])
+
+
+class explain(Executable, ClauseElement):
+    def __init__(self, statement):
+        self.statement = statement
+
+@compiles(explain, "sqlite")
+def compile_explain(element, compiler, **kw):
+    return "EXPLAIN QUERY PLAN " + compiler.process(element.statement, **kw)
+
+def query_plan(sess, query):
+    """
+    Returns the lines of the SQLite query plan for `query`.
+    """
+    return [row[-1] for row in sess.execute(explain(query.statement))]
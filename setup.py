@@ -23,7 +23,7 @@ setup(
 
     license='MIT',
 
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     
     zip_safe = False,
 
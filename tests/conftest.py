@@ -0,0 +1,90 @@
+import datetime
+from decimal import Decimal
+import io
+import logging
+import sys
+
+import pytest
+
+from invoice import invoice
+from invoice import model
+from invoice import __version__
+
+TEMPLATE = """taxes:
+   service: 0.14
+rows: |
+        | Serial no | Description | Total |
+footer: |
+        | | Net total | {net_total} |
+        | | Service tax | {service} |
+        | | b:Gross total | {gross_total} |
+"""
+
+def letterhead():
+    """
+    A one page letterhead PDF.
+    """
+    from reportlab.pdfgen import canvas
+    out = io.BytesIO()
+    c = canvas.Canvas(out, invariant = 1)
+    c.setFont("Helvetica-Bold", 24)
+    c.drawString(40, 780, "Example Letterhead")
+    c.save()
+    return out.getvalue()
+
+def create_database(db_file, invoices = 5, lines = 3, timesheets = 2, days = 5, with_letterhead = True):
+    """
+    Creates `db_file` with one account and client, a template and the
+    given numbers of invoices and timesheets. The schema is created
+    like model.create_database() does, without stamping the alembic
+    version, which the commands don't look at.
+    """
+    from sqlalchemy import create_engine
+    model.Base.metadata.create_all(create_engine("sqlite:///{}".format(db_file)))
+    sess = model.get_session(db_file)
+    sess.add(model.Config(name = "version", value = __version__, system = True))
+    account = model.Account(name = "account", signatory = "Signatory", address = "1 Street\\nCity",
+                            phone = "5550100", email = "accounts@example.com",
+                            bank_details = "Example Bank\\nIFSC EXMP0000001", prefix = "EX")
+    client = model.Client(name = "client", bill_unit = "INR", address = "2 Road\\nTown",
+                          account = account, billing_dom = 1)
+    template = model.InvoiceTemplate(name = "template", description = "Template")
+    template.set_template(TEMPLATE)
+    template.set_letterhead(sess, letterhead() if with_letterhead else b'')
+    tag = model.InvoiceTag(name = "paid")
+    sess.add_all([account, client, template, tag, model.InvoiceTag(name = "cancelled", system = True)])
+    start = datetime.date(2020, 1, 1)
+    for i in range(invoices):
+        item = model.Invoice(disp_number = i + 1, date = start + datetime.timedelta(days = i),
+                             particulars = "Work {}".format(i), template = template, client = client)
+        item.set_content("\n".join("| {} | Task {} | {} |".format(j + 1, j, 100 * (j + 1) + i)
+                                   for j in range(lines)))
+        if i % 2:
+            item.tags.append(tag)
+        sess.add(item)
+    for i in range(timesheets):
+        timesheet = model.Timesheet(employee = "employee", description = "Timesheet {}".format(i),
+                                    date = start + datetime.timedelta(days = i),
+                                    template = template, client = client)
+        timesheet.set_entries({start + datetime.timedelta(days = d): Decimal("7.5") for d in range(days)})
+        sess.add(timesheet)
+    sess.commit()
+    return db_file
+
+
+@pytest.fixture(autouse = True)
+def no_render_cache(monkeypatch):
+    # Tests never read or fill the user's render cache
+    monkeypatch.setenv("INVOICE_RENDER_CACHE", "")
+
+@pytest.fixture
+def run(monkeypatch):
+    """
+    Runs the invoice command line with the given arguments in this
+    process.
+    """
+    invoice.l = logging.getLogger("invoice")
+    def run(*argv):
+        monkeypatch.setattr(sys, "argv", ["invoice"] + [str(x) for x in argv])
+        invoice.dispatch(invoice.parse_args())
+    return run
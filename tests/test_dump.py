@@ -0,0 +1,50 @@
+import io
+import json
+import sqlite3
+
+import pytest
+
+from invoice import dump, model
+
+from conftest import create_database
+
+def dumped(db_file):
+    connection = sqlite3.connect(db_file)
+    out = io.StringIO()
+    dump.dump(connection, out)
+    connection.close()
+    return out.getvalue()
+
+def load(db_file, lines):
+    connection = sqlite3.connect(db_file)
+    try:
+        counts = dump.load(connection, lines)
+        connection.commit()
+    finally:
+        connection.close()
+    return counts
+
+def test_load_replaces_contents(tmp_path):
+    original = dumped(create_database(str(tmp_path / "a.db")))
+    other = create_database(str(tmp_path / "b.db"), invoices = 8, timesheets = 4)
+    for _ in range(2):
+        counts = load(other, original.splitlines())
+    assert dumped(other) == original
+    assert counts[model.association_table.name] == 2
+
+def test_load_refuses_unknown_tables(tmp_path):
+    db = create_database(str(tmp_path / "a.db"))
+    lines = dumped(db).splitlines()
+    lines.append(json.dumps({"table" : "nonsense", "row" : {}}))
+    with pytest.raises(ValueError, match = "Unknown table 'nonsense'"):
+        load(db, lines)
+
+def test_load_refuses_other_database_versions(tmp_path):
+    db = create_database(str(tmp_path / "a.db"))
+    lines = dumped(db).splitlines()
+    connection = sqlite3.connect(db)
+    connection.execute("UPDATE config SET value = '0.1.0-alpha' WHERE name = 'version'")
+    connection.commit()
+    connection.close()
+    with pytest.raises(ValueError, match = "Database is of version 0.1.0-alpha"):
+        load(db, lines)
@@ -0,0 +1,56 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from invoice import model
+from invoice.formatters import PDFFormatter
+
+from conftest import create_database
+
+# The workers only see the patched formatter if they're forked
+pytestmark = pytest.mark.skipif(multiprocessing.get_start_method() != "fork",
+                                reason = "Workers aren't forked")
+
+create_invoice_layer = PDFFormatter.PDFFormatter.create_invoice_layer
+
+def partial_write(out):
+    if out is not None:
+        out.write(b"%PDF-1.4\n")
+        out.flush()
+
+def leftovers(dir):
+    return [x for x in os.listdir(dir) if x.endswith(".tmp")]
+
+def test_failed_document_leaves_no_temporary_files(tmp_path, run, monkeypatch):
+    def failing(self, invoice_data, letterhead = None, out = None):
+        if invoice_data['particulars'] == "Work 2":
+            partial_write(out)
+            raise ValueError("Broken invoice")
+        return create_invoice_layer(self, invoice_data, letterhead, out)
+    monkeypatch.setattr(PDFFormatter.PDFFormatter, "create_invoice_layer", failing)
+    db = create_database(str(tmp_path / "db"), invoices = 6)
+    out = tmp_path / "out"
+
+    with pytest.raises(RuntimeError, match = "1 of 6 documents"):
+        run("-f", db, "-o", out, "invoice", "generate", "-f", "01/Jan/2000", "-t", "01/Jan/2030",
+            "--format", "pdf", "--jobs", "2")
+    assert leftovers(out) == []
+    assert len(os.listdir(out)) == 5
+
+def test_stopped_batch_leaves_no_temporary_files(tmp_path, monkeypatch):
+    def slow(self, invoice_data, letterhead = None, out = None):
+        partial_write(out)
+        time.sleep(0.5)
+        return create_invoice_layer(self, invoice_data, letterhead, out)
+    monkeypatch.setattr(PDFFormatter.PDFFormatter, "create_invoice_layer", slow)
+    db = create_database(str(tmp_path / "db"), invoices = 8)
+    invoices = model.get_session(db).query(model.Invoice).all()
+    out = str(tmp_path / "out")
+
+    batch = PDFFormatter.PDFFormatter(out).generate_batch("invoice", invoices, jobs = 2)
+    next(batch)
+    # The other worker is partway through writing its document
+    batch.close()
+    assert leftovers(out) == []
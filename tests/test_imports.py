@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+# Modules only the commands that need them import
+HEAVY = ["reportlab", "PyPDF2", "alembic", "yaml"]
+
+# Seconds importing invoice.invoice may take, all told
+BUDGET = 1.0
+
+def importtime(module):
+    """
+    Returns the cumulative import time in microseconds of each module
+    imported by `module`, from python -X importtime, and the total.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+                          cwd = root, stderr = subprocess.PIPE, universal_newlines = True, check = True)
+    modules, total = {}, 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue # The header
+        modules[name.strip()] = int(cumulative)
+        if not name.startswith("  "):
+            # Imported at the top level, so not counted in another's time
+            total += int(cumulative)
+    return modules, total
+
+def test_heavy_modules_not_imported():
+    modules, _ = importtime("invoice.invoice")
+    assert "invoice.invoice" in modules
+    imported = [x for x in modules if x.split(".")[0] in HEAVY]
+    assert imported == []
+
+def test_import_time():
+    _, total = importtime("invoice.invoice")
+    assert total / 1e6 < BUDGET
@@ -0,0 +1,30 @@
+import tracemalloc
+
+import pytest
+
+from invoice import model
+from invoice.formatters.PDFFormatter import PDFFormatter, get_letterhead_form
+
+from conftest import create_database
+
+# Bytes Python may allocate at the peak of writing one PDF, short or
+# long
+PEAK_LIMIT = 8 * 1024 * 1024
+
+@pytest.mark.parametrize("lines", [3, 1000])
+def test_pdf_peak_memory(tmp_path, lines):
+    db = create_database(str(tmp_path / "db"), invoices = 1, lines = lines, timesheets = 0)
+    invoice = model.get_session(db).query(model.Invoice).one()
+    formatter = PDFFormatter(str(tmp_path / "out"))
+    data = invoice.serialise()
+    letterhead = formatter.get_letterhead(invoice.template)
+    # Drawn over the letterhead as it's laid out, not merged afterwards
+    assert get_letterhead_form(letterhead)
+
+    tracemalloc.start()
+    try:
+        formatter.write_invoice(data, letterhead, str(tmp_path / "out" / "invoice.pdf"))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < PEAK_LIMIT
@@ -0,0 +1,86 @@
+import datetime
+from decimal import Decimal
+import os
+
+from invoice import orgmode
+
+def day(n, hours = 1):
+    date = datetime.date(2020, 1, 1) + datetime.timedelta(days = n)
+    stamp = date.strftime("%Y-%m-%d %a")
+    return ("** <{0}>\n"
+            "   CLOCK: [{0} 09:00]--[{0} {1:02}:00] => {2}:00\n").format(stamp, 9 + hours, hours)
+
+def test_appended_lines_are_read_alone(tmp_path):
+    fname = str(tmp_path / "log.org")
+    with open(fname, "w") as f:
+        f.write("* Log\n" + day(0) + day(1))
+    hours, watermark, complete = orgmode.clocked_hours_since(fname)
+    assert complete and len(hours) == 2
+    assert watermark.offset == watermark.size == os.path.getsize(fname)
+
+    with open(fname, "a") as f:
+        f.write(day(2, 3))
+    hours, watermark, complete = orgmode.clocked_hours_since(fname, watermark)
+    assert not complete
+    assert hours == {datetime.date(2020, 1, 3): Decimal(3)}
+
+    hours, _, complete = orgmode.clocked_hours_since(fname, watermark)
+    assert not complete and hours == {}
+
+def test_running_clock_is_read_next_time(tmp_path):
+    fname = str(tmp_path / "log.org")
+    with open(fname, "w") as f:
+        f.write(day(0) + "** <2020-01-02 Thu>\n   CLOCK: [2020-01-02 Thu 09:00]\n")
+    hours, watermark, _ = orgmode.clocked_hours_since(fname)
+    assert list(hours) == [datetime.date(2020, 1, 1)]
+
+    with open(fname, "w") as f:
+        f.write(day(0) + day(1, 2))
+    hours, _, complete = orgmode.clocked_hours_since(fname, watermark)
+    assert not complete
+    assert hours == {datetime.date(2020, 1, 2): Decimal(2)}
+
+def test_changed_files_are_read_again(tmp_path):
+    fname = str(tmp_path / "log.org")
+    with open(fname, "w") as f:
+        f.write(day(0) + day(1))
+    _, watermark, _ = orgmode.clocked_hours_since(fname)
+
+    # Edited just before the watermark, in place
+    with open(fname, "r+") as f:
+        f.write(day(0, 2))
+    hours, _, complete = orgmode.clocked_hours_since(fname, watermark)
+    assert complete and hours[datetime.date(2020, 1, 1)] == 2
+
+    # Replaced by a new file that starts the same
+    os.rename(fname, fname + "~")
+    with open(fname, "w") as f:
+        f.write(day(0) + day(1) + day(2))
+    hours, _, complete = orgmode.clocked_hours_since(fname, watermark)
+    assert complete and len(hours) == 3
+
+    # Truncated
+    _, watermark, _ = orgmode.clocked_hours_since(fname)
+    with open(fname, "r+") as f:
+        f.truncate(len(day(0)))
+    hours, _, complete = orgmode.clocked_hours_since(fname, watermark)
+    assert complete and len(hours) == 1
+
+def test_reads_cost_the_new_lines(tmp_path, monkeypatch):
+    fname = str(tmp_path / "log.org")
+    with open(fname, "w") as f:
+        f.write("".join(day(n) for n in range(5000)))
+    _, watermark, _ = orgmode.clocked_hours_since(fname)
+    with open(fname, "a") as f:
+        f.write(day(5000))
+
+    hashed = []
+    tail_checksum = orgmode.tail_checksum
+    def checksum(data, offset):
+        hashed.append(min(offset, orgmode.TAIL))
+        return tail_checksum(data, offset)
+    monkeypatch.setattr(orgmode, "tail_checksum", checksum)
+    hours, _, complete = orgmode.clocked_hours_since(fname, watermark)
+    assert not complete and len(hours) == 1
+    assert watermark.offset > 2 * orgmode.TAIL
+    assert hashed == [orgmode.TAIL, orgmode.TAIL]
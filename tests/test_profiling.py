@@ -0,0 +1,25 @@
+import datetime
+import logging
+
+from invoice import model, profiling
+from invoice.formatters.TextFormatter import TextFormatter
+
+from conftest import create_database
+
+def test_documents_with_the_same_name_are_profiled_apart(tmp_path, caplog):
+    db = create_database(str(tmp_path / "db"), invoices = 0, timesheets = 2)
+    sess = model.get_session(db)
+    for timesheet in sess.query(model.Timesheet):
+        timesheet.date = datetime.date(2020, 1, 1)
+    sess.commit()
+    timesheets = sess.query(model.Timesheet).all()
+    assert len(set(x.file_name for x in timesheets)) == 1
+
+    profiling.start()
+    try:
+        fnames = list(TextFormatter(str(tmp_path / "out")).generate_batch("timesheet", timesheets))
+    finally:
+        with caplog.at_level(logging.INFO, logger = "invoice"):
+            profiling.stop()
+    assert len(set(fnames)) == 2
+    assert ", 2 documents," in caplog.text
@@ -0,0 +1,40 @@
+import contextlib
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from conftest import create_database
+
+@contextlib.contextmanager
+def count_statements():
+    """
+    Counts the SQL statements executed within it in the list it yields.
+    """
+    statements = []
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(Engine, "before_cursor_execute", before_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_execute)
+
+def statements(tmp_path, run, invoices, *argv):
+    db = create_database(str(tmp_path / "{}.db".format(invoices)), invoices = invoices, timesheets = invoices)
+    with count_statements() as ret:
+        run("-f", db, "-o", tmp_path / "out-{}".format(invoices), *argv)
+    return len(ret)
+
+@pytest.mark.parametrize("argv", [
+    ["summary", "-v"],
+    ["invoice", "ls", "-a"],
+    ["timesheet", "ls"],
+    ["invoice", "generate", "-f", "01/Jan/2000", "-t", "01/Jan/2030", "--format", "txt"],
+    ["invoice", "generate", "-f", "01/Jan/2000", "-t", "01/Jan/2030", "--format", "pdf"],
+    ["timesheet", "generate", "-f", "01/Jan/2000", "-t", "01/Jan/2030", "--format", "txt"],
+])
+def test_statements_do_not_grow_with_documents(tmp_path, run, capsys, argv):
+    few = statements(tmp_path, run, 3, *argv)
+    many = statements(tmp_path, run, 30, *argv)
+    assert few == many
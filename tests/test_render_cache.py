@@ -0,0 +1,17 @@
+import os
+
+from invoice import model
+from invoice.formatters.RenderCache import RenderCache
+from invoice.formatters.TextFormatter import TextFormatter
+
+from conftest import create_database
+
+def test_shown_documents_keep_the_cache_bounded(tmp_path):
+    db = create_database(str(tmp_path / "db"), invoices = 10, timesheets = 0)
+    cache = RenderCache(str(tmp_path / "cache"), 4096)
+    formatter = TextFormatter(str(tmp_path / "out"), cache)
+    for invoice in model.get_session(db).query(model.Invoice):
+        formatter.layer("invoice", invoice, formatter.create_invoice_layer)
+    sizes = [x.stat().st_size for x in os.scandir(cache.base)]
+    assert 0 < sum(sizes) <= cache.max_size
+    assert len(sizes) < 10
@@ -0,0 +1,48 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+
+from invoice import model, queries
+
+from conftest import create_database
+
+@pytest.fixture
+def sess(tmp_path):
+    """
+    The test database plus a client without an account, and an invoice
+    and timesheet for it.
+    """
+    db = create_database(str(tmp_path / "db"), invoices = 2, timesheets = 1)
+    sess = model.get_session(db)
+    client = model.Client(name = "orphan", bill_unit = "INR", address = "3 Lane", billing_dom = 1)
+    template = sess.query(model.InvoiceTemplate).one()
+    invoice = model.Invoice(disp_number = 10, date = datetime.date(2020, 2, 1), particulars = "Orphan",
+                            template = template, client = client)
+    invoice.set_content("| 1 | Task | 1000 |")
+    timesheet = model.Timesheet(employee = "employee", description = "Orphan", date = datetime.date(2020, 2, 1),
+                                template = template, client = client)
+    timesheet.set_entries({datetime.date(2020, 2, 1): Decimal("2")})
+    sess.add_all([client, invoice, timesheet])
+    sess.commit()
+    return sess
+
+def test_report_by_account_counts_clients_without_one(sess):
+    names, rows = queries.report(sess, "account")
+    assert [x["account"] for x in rows] == ["account", queries.NO_GROUP]
+    assert rows[1]["invoices"] == 1
+    assert rows[1]["net_total"] == Decimal("1000.00")
+    assert rows[1]["hours"] == Decimal("2.00")
+    assert sum(x["invoices"] for x in rows) == 3
+
+def test_report_by_client(sess):
+    names, rows = queries.report(sess, "client")
+    assert [x["client"] for x in rows] == ["client", "orphan"]
+    assert names == ["net_total", "service", "gross_total"]
+
+def test_report_groups_missing_keys_last(sess):
+    sess.query(model.Invoice).filter(model.Invoice.disp_number == 10).one().client = None
+    sess.commit()
+    names, rows = queries.report(sess, "client")
+    assert [x["client"] for x in rows] == ["client", "orphan", queries.NO_GROUP]
+    assert rows[2]["invoices"] == 1
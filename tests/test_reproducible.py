@@ -0,0 +1,55 @@
+import hashlib
+
+from PyPDF2.pdf import PageObject
+import pytest
+
+from invoice import model
+from invoice.formatters import PDFFormatter
+from invoice.formatters.TextFormatter import TextFormatter
+
+from conftest import create_database
+
+def sha256(fname):
+    with open(fname, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+@pytest.mark.parametrize("form", [True, False], ids = ["form", "merge"])
+@pytest.mark.parametrize("kind", ["invoice", "timesheet"])
+def test_pdf_is_reproducible(tmp_path, monkeypatch, form, kind):
+    if not form:
+        # As for letterheads that can't be drawn as a form
+        monkeypatch.setattr(PDFFormatter, "get_letterhead_form", lambda letterhead, key = None: None)
+        # Clashing resources are renamed before PyPDF2 would pick
+        # random names for them
+        merge = PageObject._mergeResources
+        def merge_without_renames(res1, res2, resource):
+            new, rename = merge(res1, res2, resource)
+            assert not rename
+            return new, rename
+        monkeypatch.setattr(PageObject, "_mergeResources", staticmethod(merge_without_renames))
+    db = create_database(str(tmp_path / "db"), invoices = 1, lines = 60, timesheets = 1, days = 60)
+    sess = model.get_session(db)
+    document = sess.query(model.Invoice if kind == "invoice" else model.Timesheet).one()
+    formatter = PDFFormatter.PDFFormatter(str(tmp_path / "out"))
+    data = document.serialise()
+    letterhead = formatter.get_letterhead(document.template)
+
+    digests = []
+    for i in range(2):
+        # Each time as if in a new process
+        PDFFormatter.letterhead_cache.entries.clear()
+        PDFFormatter.form_cache.entries.clear()
+        fname = str(tmp_path / "out" / "{}-{}.pdf".format(kind, i))
+        formatter.write(kind, data, None, letterhead, fname)
+        digests.append(sha256(fname))
+    assert digests[0] == digests[1]
+
+def test_text_is_reproducible(tmp_path):
+    db = create_database(str(tmp_path / "db"), invoices = 1, timesheets = 0)
+    invoice = model.get_session(db).query(model.Invoice).one()
+    formatter = TextFormatter(str(tmp_path / "out"))
+    data = invoice.serialise()
+    fnames = [str(tmp_path / "out" / "invoice-{}.txt".format(i)) for i in range(2)]
+    for fname in fnames:
+        formatter.write_invoice(data, None, fname)
+    assert sha256(fnames[0]) == sha256(fnames[1])